@@ -0,0 +1,318 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+
+from export_history import parse_ingredients_prompt, iter_lines
+from model_router import estimate_prompt_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def read_configs(path: str = 'configs.json') -> dict:
+    # Load the cache warmer section of the configs.json file
+    with open(path, 'r') as f:
+        configs = json.load(f)
+    return configs['configs']['recipe_manager_ai']['cache_warmer']
+
+
+def normalize_quantity(quantity) -> str:
+    # "2", "2.0" and "2.00" are the same quantity
+    try:
+        return f"{float(quantity):g}"
+    except (TypeError, ValueError):
+        return str(quantity).strip().lower()
+
+
+def combination_key(request: dict) -> str:
+    """
+    Compute the key of a pantry combination: its ingredients, instructions and strictness,
+    regardless of case, spacing and order.
+
+    Args:
+        request (dict): The ingredients prompt of a request, see parse_ingredients_prompt.
+
+    Returns:
+        str: The sha256 hex digest of the normalized combination.
+    """
+    ingredients = sorted(
+        [str(i.get("name", "")).strip().lower(), normalize_quantity(i.get("quantity")),
+         str(i.get("unit_of_measure", "")).strip().lower()]
+        for i in request.get("ingredients") or [] if isinstance(i, dict)
+    )
+    # "Italian cuisine, 4 servings" and "4 servings. italian  cuisine" are the same instructions
+    instructions = sorted(
+        " ".join(part.split()) for part in re.split(r"[,.;]", str(request.get("instruction", "")).lower())
+        if part.strip()
+    )
+    canonical = json.dumps({
+        "ingredients": ingredients,
+        "instructions": instructions,
+        "is_strict_ingredients": str(request.get("is_strict_ingredients", "no")).strip().lower(),
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def mine_combinations(path: str, top_n: int, min_count: int) -> list:
+    """
+    Find the most frequent pantry combinations of the saved requests.
+
+    Args:
+        path (str): The requests.json file.
+        top_n (int): The number of combinations to keep.
+        min_count (int): The number of requests below which a combination is ignored.
+
+    Returns:
+        list: (key, count, request) tuples, most frequent first. request is the ingredients
+              prompt of the first request of the combination.
+    """
+    counts = Counter()
+    requests = {}
+    if not os.path.exists(path):
+        return []
+    for _, _, line in iter_lines(path, 0):
+        try:
+            request = parse_ingredients_prompt(json.loads(line).get("recipe_prompt"))
+        except (ValueError, AttributeError):
+            continue
+        if not request:
+            continue
+        key = combination_key(request)
+        counts[key] += 1
+        requests.setdefault(key, request)
+    return [(key, count, requests[key]) for key, count in counts.most_common(top_n) if count >= min_count]
+
+
+class warm_cache:
+    """
+    This class holds the recipes precomputed by the cache warmer, by combination key.
+    """
+
+    def __init__(self, path: str, max_age_s: float):
+        self.path = path
+        self.max_age_s = max_age_s
+        self.lock = threading.Lock()
+        self.entries = {}
+        # (warmed_at, tokens) of every warming, to enforce the token budget
+        self.spent = []
+        self.mtime = None
+        self.reload()
+
+    def reload(self) -> None:
+        """
+        Load the cache file again if the warmer changed it. The last entry of a key wins.
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            entries, spent = {}, []
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a partially written last line is skipped
+                        continue
+                    entries[entry["key"]] = entry
+                    spent.append((entry["warmed_at"], entry["tokens"]))
+            self.entries, self.spent, self.mtime = entries, spent, mtime
+
+    def find(self, key: str, max_age_s: Optional[float] = None) -> Optional[dict]:
+        """
+        Get the precomputed recipe of a combination.
+
+        Args:
+            key (str): The combination key.
+            max_age_s (float): Overrides the configured maximum age.
+
+        Returns:
+            dict: The cache entry, or None if it is missing or too old.
+        """
+        self.reload()
+        entry = self.entries.get(key)
+        max_age_s = self.max_age_s if max_age_s is None else max_age_s
+        if entry is None or time.time() - entry["warmed_at"] > max_age_s:
+            return None
+        return entry
+
+    def add(self, entry: dict) -> None:
+        """
+        Append a precomputed recipe to the cache file.
+        """
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.entries[entry["key"]] = entry
+            self.spent.append((entry["warmed_at"], entry["tokens"]))
+
+    def spent_tokens(self, since: float) -> int:
+        """
+        Count the tokens spent warming the cache since a time.
+        """
+        with self.lock:
+            return sum(tokens for warmed_at, tokens in self.spent if warmed_at >= since)
+
+
+def find_warmed_recipe(self, messages: list) -> Optional[dict]:
+    """
+    Get the precomputed recipe of a recipe request, if the warmer prepared it.
+
+    Args:
+        self (object): The object.
+        messages (list): The chat messages of the request.
+
+    Returns:
+        dict: The cache entry, with the response and the outputs of save_recipe_response, or None.
+    """
+    if self.warm_cache is None:
+        return None
+    request = parse_ingredients_prompt(messages)
+    if not request:
+        return None
+    return self.warm_cache.find(combination_key(request))
+
+
+def is_idle(self, configs: dict) -> bool:
+    """
+    Check if the application is idle: no request was saved for idle_after_s and,
+    when idle_hours is set, the current hour is one of them.
+
+    Args:
+        self (object): The object.
+        configs (dict): The cache warmer configs.
+
+    Returns:
+        bool: True if the cache can be warmed.
+    """
+    if configs["idle_hours"] and datetime.now().hour not in configs["idle_hours"]:
+        return False
+    try:
+        last_request = os.path.getmtime(self.db_path + "/requests.json")
+    except OSError:
+        return True
+    return time.time() - last_request >= configs["idle_after_s"]
+
+
+def warm(self, cache: warm_cache, configs: dict) -> dict:
+    """
+    Generate or refresh the recipes and images of the most frequent combinations,
+    while the application is idle and the token budget of the period is not spent.
+
+    Args:
+        self (object): The object.
+        cache (warm_cache): The cache.
+        configs (dict): The cache warmer configs.
+
+    Returns:
+        dict: The number of combinations warmed, fresh and failed, the tokens spent and why the run stopped.
+    """
+    from recipe_manager_ai import create_recipe_prompt, create_recipe_from_ai, save_recipe_response
+    from write_behind import flush_write_behind
+
+    stats = {"warmed": 0, "fresh": 0, "failed": 0, "tokens": 0, "stopped": "done"}
+    now = time.time()
+    budget = configs["token_budget"] - cache.spent_tokens(now - configs["budget_period_s"])
+    combinations = mine_combinations(self.db_path + "/requests.json", configs["top_n"], configs["min_count"])
+    for key, count, request in combinations:
+        if cache.find(key, configs["refresh_after_s"]) is not None:
+            stats["fresh"] += 1
+            continue
+        if not is_idle(self, configs):
+            stats["stopped"] = "busy"
+            break
+        ingredient_list = [json.dumps({"name": i.get("name", ""), "quantity": i.get("quantity", ""),
+                                       "unit_of_measure": i.get("unit_of_measure", "")})
+                           for i in request["ingredients"]]
+        messages = create_recipe_prompt(self, ingredient_list, request.get("instruction", ""),
+                                        request.get("is_strict_ingredients", "no"))
+        if not messages:
+            stats["failed"] += 1
+            continue
+        estimate = estimate_prompt_tokens(self, messages) + self.chat_completion_max_completion_length
+        if estimate > budget:
+            stats["stopped"] = "budget"
+            break
+        response = create_recipe_from_ai(self, messages)
+        if response is None:
+            stats["failed"] += 1
+            continue
+        response = json.loads(json.dumps(response))
+        tokens = (response.get("usage") or {}).get("total_tokens", estimate)
+        budget -= tokens
+        stats["tokens"] += tokens
+        _, _, outputs = save_recipe_response(self, response)
+        # the entry is only added once its files and images are on disk
+        if not flush_write_behind(self):
+            stats["failed"] += 1
+            continue
+        cache.add({"key": key, "count": count, "request": request, "response": response,
+                   "outputs": outputs, "tokens": tokens, "warmed_at": time.time()})
+        stats["warmed"] += 1
+        self.logger.info("Warmed combination %s (%d requests, %d tokens).", key[:12], count, tokens)
+    return stats
+
+
+def run(configs: dict, once: bool = False) -> None:
+    """
+    Warm the cache whenever the application is idle, every interval_s.
+
+    Args:
+        configs (dict): The cache warmer configs.
+        once (bool): Warm once, even if the application is not idle, and exit.
+
+    Returns:
+        None
+    """
+    from recipe_manager_ai import recipe_manager_ai
+    from write_behind import stop_write_behind
+
+    app = recipe_manager_ai()
+    cache = warm_cache(configs["path"], configs["max_age_s"])
+    try:
+        while True:
+            if once:
+                print(json.dumps(warm(app, cache, dict(configs, idle_hours=[], idle_after_s=0))))
+                break
+            if is_idle(app, configs):
+                app.logger.info("Cache warming: %s", warm(app, cache, configs))
+            time.sleep(configs["interval_s"])
+    finally:
+        stop_write_behind(app)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s | %(levelname)s: %(message)s",
+        datefmt="%b/%d %H:%M:%S",
+        level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description="Precompute the recipes of the most frequent pantry combinations.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("top", help="list the most frequent combinations and their cache state")
+    run_parser = subparsers.add_parser("run", help="warm the cache during the idle periods")
+    run_parser.add_argument("--once", action="store_true", help="warm once now and exit")
+    args = parser.parse_args()
+
+    configs = read_configs()
+    if args.command == "top":
+        # the same requests as the run command, from the db path of the configs
+        with open('configs.json', 'r') as f:
+            db_path = json.load(f)['configs']['recipe_manager_ai']['db']['path']
+        cache = warm_cache(configs["path"], configs["max_age_s"])
+        for key, count, request in mine_combinations(db_path + "/requests.json", configs["top_n"], configs["min_count"]):
+            state = "cached" if cache.find(key) else "missing"
+            names = ", ".join(i.get("name", "") for i in request.get("ingredients", []))
+            print(f"{count:6d} {state:7s} {key[:12]} {names} | {request.get('instruction', '')}")
+    else:
+        run(configs, args.once)
@@ -0,0 +1,517 @@
+import argparse
+import ast
+import csv
+import json
+import logging
+import os
+import re
+from datetime import date, datetime, timedelta
+from itertools import islice
+from pathlib import Path
+from typing import Iterator
+
+from output_store import iter_bundle_index, read_bundle_entry
+from recipe_scaler import parse_quantity
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # only the CSV export is available without pyarrow
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# the ingredients_prompt inserted by create_recipe_prompt into the query
+INGREDIENTS_PROMPT_PATTERN = re.compile(r'\{"instruction":.*?"ingredients":\[.*?\]\}')
+
+INGREDIENT_COLUMNS = [
+    ("ingredient_index", "int"), ("ingredient_name", "str"), ("ingredient_quantity", "str"),
+    ("ingredient_quantity_value", "float"), ("ingredient_unit", "str"),
+]
+RECIPE_COLUMNS = [
+    ("recipe_name", "str"), ("category", "str"), ("servings", "str"), ("preparation_time", "str"),
+    ("cooking_time", "str"), ("total_cooking_time", "str"),
+]
+TABLES = {
+    "recipes": [
+        ("record_offset", "int"), ("response_id", "str"), ("created", "int"), ("model", "str"),
+        ("prompt_tokens", "int"), ("completion_tokens", "int"), ("total_tokens", "int"), ("choice_index", "int"),
+    ] + RECIPE_COLUMNS + INGREDIENT_COLUMNS,
+    "requests": [
+        ("record_offset", "int"), ("instruction", "str"), ("is_strict_ingredients", "str"),
+    ] + INGREDIENT_COLUMNS,
+    "results": [
+        ("file", "str"), ("modified", "float"),
+    ] + RECIPE_COLUMNS + INGREDIENT_COLUMNS,
+}
+
+
+def read_configs(path: str = 'configs.json') -> dict:
+    # Load the recipe manager section of the configs.json file
+    with open(path, 'r') as f:
+        configs = json.load(f)
+    return configs['configs']['recipe_manager_ai']
+
+
+def iter_lines(path: str, offset: int) -> Iterator[tuple]:
+    """
+    Stream the complete lines of an append-only file from a byte offset.
+
+    Args:
+        path (str): The file.
+        offset (int): The byte offset to start from.
+
+    Yields:
+        tuple: (offset of the line, offset after the line, line)
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # a line still being written is exported by the next run
+                return
+            yield offset, offset + len(line), line
+            offset += len(line)
+
+
+def ingredient_rows(ingredients) -> Iterator[dict]:
+    """
+    Flatten a list of ingredients into rows, one empty row if there is none.
+
+    Args:
+        ingredients (list): The ingredients.
+
+    Yields:
+        dict: The ingredient columns.
+    """
+    if not isinstance(ingredients, list) or not ingredients:
+        yield {}
+        return
+    for index, ingredient in enumerate(ingredients):
+        if not isinstance(ingredient, dict):
+            ingredient = {"name": str(ingredient)}
+        quantity = ingredient.get("quantity")
+        value = parse_quantity(quantity if isinstance(quantity, (str, int, float)) else None)[0]
+        yield {
+            "ingredient_index": index,
+            "ingredient_name": ingredient.get("name"),
+            "ingredient_quantity": None if quantity is None else str(quantity),
+            "ingredient_quantity_value": None if value != value else value,
+            "ingredient_unit": ingredient.get("unit_of_measure"),
+        }
+
+
+def recipe_columns(recipe: dict) -> dict:
+    """
+    Get the recipe columns of a generated recipe.
+
+    Args:
+        recipe (dict): The recipe.
+
+    Returns:
+        dict: The recipe columns, as strings since the model does not always emit numbers.
+    """
+    return {name: None if recipe.get(name) is None else str(recipe.get(name)) for name, _ in RECIPE_COLUMNS}
+
+
+def iter_recipe_rows(path: str, state: dict) -> Iterator[dict]:
+    """
+    Stream the responses of responses.json as one row per generated ingredient, with the token usage.
+
+    Args:
+        path (str): The responses.json file.
+        state (dict): The export state of the file, its offset is advanced as rows are produced.
+
+    Yields:
+        dict: The rows of the recipes table.
+    """
+    for start, end, line in iter_lines(path, state["offset"]):
+        state["offset"] = end
+        try:
+            response = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(response, dict) or "choices" not in response:
+            continue
+        usage = response.get("usage") or {}
+        base = {
+            "record_offset": start,
+            "response_id": response.get("id"),
+            "created": response.get("created"),
+            "model": response.get("model"),
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+            "total_tokens": usage.get("total_tokens"),
+        }
+        for choice_index, choice in enumerate(response["choices"]):
+            try:
+                recipe = json.loads(choice["message"]["content"])
+            except (ValueError, KeyError, TypeError):
+                recipe = {}
+            if not isinstance(recipe, dict):
+                recipe = {}
+            row = dict(base, choice_index=choice_index, **recipe_columns(recipe))
+            for ingredient in ingredient_rows(recipe.get("ingredients")):
+                yield dict(row, **ingredient)
+
+
+def parse_ingredients_prompt(recipe_prompt) -> dict:
+    """
+    Find the ingredients prompt of a request saved by save_request_to_db.
+
+    Args:
+        recipe_prompt (str or list): The prompt string or the chat messages of the request.
+
+    Returns:
+        dict: The instruction, is_strict_ingredients and ingredients of the request, or None.
+    """
+    if isinstance(recipe_prompt, list):
+        recipe_prompt = " ".join(m.get("content", "") for m in recipe_prompt if isinstance(m, dict))
+    if not isinstance(recipe_prompt, str):
+        return None
+    # the last match is the request, the earlier ones are examples of the prompt
+    for match in reversed(INGREDIENTS_PROMPT_PATTERN.findall(recipe_prompt)):
+        try:
+            return json.loads(match)
+        except ValueError:
+            continue
+    return None
+
+
+def iter_request_rows(path: str, state: dict) -> Iterator[dict]:
+    """
+    Stream the requests of requests.json as one row per requested ingredient.
+
+    Args:
+        path (str): The requests.json file.
+        state (dict): The export state of the file, its offset is advanced as rows are produced.
+
+    Yields:
+        dict: The rows of the requests table.
+    """
+    for start, end, line in iter_lines(path, state["offset"]):
+        state["offset"] = end
+        try:
+            request = parse_ingredients_prompt(json.loads(line).get("recipe_prompt"))
+        except (ValueError, AttributeError):
+            continue
+        if request is None:
+            continue
+        row = {
+            "record_offset": start,
+            "instruction": request.get("instruction"),
+            "is_strict_ingredients": request.get("is_strict_ingredients"),
+        }
+        for ingredient in ingredient_rows(request.get("ingredients")):
+            yield dict(row, **ingredient)
+
+
+def shard_end(output_path: str, path: str) -> float:
+    """
+    Get the end of the period of a date shard directory, e.g. the next midnight for 2023/05/12.
+
+    Args:
+        output_path (str): The output directory of the chat completions.
+        path (str): The directory.
+
+    Returns:
+        float: The timestamp of the end of the year, month or day of the directory,
+               infinity if the directory is not a date shard.
+    """
+    parts = Path(os.path.relpath(path, output_path)).parts
+    if not 1 <= len(parts) <= 3 or not all(part.isdigit() for part in parts):
+        return float("inf")
+    year, month, day = (list(map(int, parts)) + [0, 0])[:3]
+    try:
+        if day:
+            end = date(year, month, day) + timedelta(days=1)
+        elif month:
+            end = date(year + month // 12, month % 12 + 1, 1)
+        else:
+            end = date(year + 1, 1, 1)
+    except (ValueError, OverflowError):
+        return float("inf")
+    # the result ids, and so the shards, use the local time
+    return datetime.combine(end, datetime.min.time()).timestamp()
+
+
+def iter_result_files(output_path: str, since: float = 0.0) -> Iterator[os.DirEntry]:
+    """
+    Stream the "_JSON_" result files of the output directory and of its date shards.
+
+    Args:
+        output_path (str): The output directory of the chat completions.
+        since (float): The date shards that ended before this time are not scanned.
+
+    Yields:
+        os.DirEntry: The result files.
+    """
+    if not os.path.isdir(output_path):
+        return
+    directories = [output_path]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # the bundles are read from their index, see iter_bundle_rows
+                    if entry.name != "bundles" and shard_end(output_path, entry.path) >= since:
+                        directories.append(entry.path)
+                # not the temporary files of the writes being replaced
+                elif (entry.name.startswith("result__JSON_") and entry.name.endswith((".txt", ".md"))
+                      and entry.is_file()):
+                    yield entry
+
+
+def parse_result(content: str):
+    """
+    Parse the content of a "_JSON_" result.
+
+    Args:
+        content (str): The result.
+
+    Returns:
+        dict: The recipe, or None if the result is not a recipe.
+    """
+    try:
+        try:
+            recipe = json.loads(content)
+        except ValueError:
+            # the result files hold the repr of the recipe dict
+            recipe = ast.literal_eval(content)
+    except (ValueError, SyntaxError):
+        return None
+    return recipe if isinstance(recipe, dict) else None
+
+
+def iter_result_rows(output_path: str, state: dict, margin_s: float = 60) -> Iterator[dict]:
+    """
+    Stream the recipes of the "_JSON_" result files modified since the last export.
+
+    A result file is renamed into place with the modification time of its temporary file,
+    which can be older than the newest file of the previous export. So the files modified
+    up to margin_s before the newest exported one are scanned again, and skipped by name
+    if they were already exported. Only the names within margin_s of the newest file are
+    kept, and the date shards older than the margins are not scanned.
+
+    Args:
+        output_path (str): The output directory of the chat completions.
+        state (dict): The export state of the results, with the modification time of the
+                      newest exported file, the names and modification times of the files
+                      exported within margin_s of it and the exported offset of each bundle index.
+        margin_s (float): The safety margin of the modification times, in seconds.
+
+    Yields:
+        dict: The rows of the results table.
+    """
+    watermark = state["mtime"]
+    names = state["names"]
+    # the names exported within margin_s of the watermark, the previous state format listed only those at it
+    exported = dict.fromkeys(names, watermark) if isinstance(names, list) else dict(names)
+    # the names of this export within margin_s of its newest file, pruned as the newest file moves
+    recent = {}
+    prune_at = 1000
+    newest = watermark
+    # a result is written within margin_s of its id, so the older date shards only hold exported files
+    for entry in iter_result_files(output_path, watermark - 2 * margin_s):
+        mtime = entry.stat().st_mtime
+        if mtime < watermark - margin_s or entry.name in exported:
+            continue
+        newest = max(newest, mtime)
+        if mtime >= newest - margin_s:
+            recent[entry.name] = mtime
+            if len(recent) >= prune_at:
+                recent = {name: m for name, m in recent.items() if m >= newest - margin_s}
+                prune_at = max(1000, 2 * len(recent))
+        try:
+            with open(entry.path, "r", encoding="utf-8") as f:
+                recipe = parse_result(f.read())
+        except OSError:
+            continue
+        if recipe is None:
+            continue
+        row = dict({"file": entry.name, "modified": mtime}, **recipe_columns(recipe))
+        for ingredient in ingredient_rows(recipe.get("ingredients")):
+            yield dict(row, **ingredient)
+    state["mtime"] = newest
+    state["names"] = {name: mtime for name, mtime in list(exported.items()) + list(recent.items())
+                      if mtime >= newest - margin_s}
+    yield from iter_bundle_rows(output_path, state.setdefault("bundles", {}))
+
+
+def iter_bundle_rows(output_path: str, offsets: dict) -> Iterator[dict]:
+    """
+    Stream the recipes of the "_JSON_" results appended to the bundles since the last export.
+
+    Args:
+        output_path (str): The output directory of the chat completions.
+        offsets (dict): The byte offset up to which each bundle index was exported.
+
+    Yields:
+        dict: The rows of the results table.
+    """
+    for index_path in sorted(Path(output_path).glob("bundles/*/*.idx")):
+        key = str(index_path)
+        for end, entry in iter_bundle_index(key, offsets.get(key, 0)):
+            offsets[key] = end
+            if entry.get("suffix") != "_JSON_":
+                continue
+            bundle_path = str(index_path.parent / entry["bundle"])
+            recipe = parse_result(read_bundle_entry(bundle_path, entry))
+            if recipe is None:
+                continue
+            row = dict({"file": f"{Path(bundle_path).name}@{entry['offset']}", "modified": None},
+                       **recipe_columns(recipe))
+            for ingredient in ingredient_rows(recipe.get("ingredients")):
+                yield dict(row, **ingredient)
+
+
+def write_table(rows: Iterator[dict], columns: list, path: str, format: str, batch_size: int) -> int:
+    """
+    Write rows to a Parquet, Arrow or CSV file, holding at most batch_size rows in memory.
+
+    Args:
+        rows (Iterator[dict]): The rows.
+        columns (list): The (name, type) columns of the table.
+        path (str): The output file, created only if there is at least one row.
+        format (str): "parquet", "arrow" or "csv".
+        batch_size (int): The number of rows per batch.
+
+    Returns:
+        int: The number of rows written.
+    """
+    if format != "csv" and pa is None:
+        raise ValueError(f"The {format} export needs pyarrow, install it or use the csv format")
+    names = [name for name, _ in columns]
+    count = 0
+    writer = None
+    f = None
+    try:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            if format == "csv":
+                if writer is None:
+                    f = open(path, "w", encoding="utf-8", newline="")
+                    writer = csv.DictWriter(f, fieldnames=names, extrasaction="ignore")
+                    writer.writeheader()
+                writer.writerows(batch)
+            else:
+                schema = pa.schema([(name, {"int": pa.int64(), "float": pa.float64(), "str": pa.string()}[kind])
+                                    for name, kind in columns])
+                record_batch = pa.RecordBatch.from_pydict(
+                    {name: [row.get(name) for row in batch] for name in names}, schema=schema)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, schema) if format == "parquet" else pa.ipc.new_file(path, schema)
+                if format == "parquet":
+                    writer.write_table(pa.Table.from_batches([record_batch]))
+                else:
+                    writer.write_batch(record_batch)
+            count += len(batch)
+    finally:
+        if f is not None:
+            f.close()
+        elif writer is not None:
+            writer.close()
+    return count
+
+
+def load_state(path: str) -> dict:
+    """
+    Load the export state, which records how far each source was exported.
+
+    Args:
+        path (str): The state file.
+
+    Returns:
+        dict: The export state.
+    """
+    state = {"responses": {"offset": 0}, "requests": {"offset": 0}, "results": {"mtime": 0.0, "names": {}}}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            state.update(json.load(f))
+    return state
+
+
+def save_state(path: str, state: dict) -> None:
+    """
+    Atomically replace the export state.
+
+    Args:
+        path (str): The state file.
+        state (dict): The export state.
+
+    Returns:
+        None
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def export_history(configs: dict, out_dir: str, format: str = "parquet", tables: list = None,
+                   incremental: bool = True, batch_size: int = 10000) -> dict:
+    """
+    Export the stored history to one file per table, only the records added since the last export
+    when incremental.
+
+    Args:
+        configs (dict): The recipe manager configs.
+        out_dir (str): The directory of the exported files.
+        format (str): "parquet", "arrow" or "csv".
+        tables (list): The tables to export, all of them by default.
+        incremental (bool): Skip the records exported by the previous runs.
+        batch_size (int): The number of rows held in memory.
+
+    Returns:
+        dict: The number of rows written per table.
+    """
+    db_path = configs["db"]["path"]
+    state_path = configs["export"]["state_path"]
+    state = load_state(state_path) if incremental else load_state("")
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    ts = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+
+    sources = {
+        "recipes": (db_path + "/responses.json", "responses", iter_recipe_rows),
+        "requests": (db_path + "/requests.json", "requests", iter_request_rows),
+    }
+    counts = {}
+    for table in tables or list(TABLES):
+        path = os.path.join(out_dir, f"{table}_{ts}.{format}")
+        if table == "results":
+            rows = iter_result_rows(configs["chat_completion"]["output_path"], state["results"],
+                                    configs["export"]["mtime_margin_s"])
+        else:
+            source, key, iter_rows = sources[table]
+            if not os.path.exists(source):
+                continue
+            if os.path.getsize(source) < state[key]["offset"]:
+                # the file was replaced or truncated, export it again
+                state[key]["offset"] = 0
+            rows = iter_rows(source, state[key])
+        counts[table] = write_table(rows, TABLES[table], path, format, batch_size)
+        logger.info("Exported %d rows to %s.", counts[table], path if counts[table] else "nothing")
+
+    save_state(state_path, state)
+    return counts
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s | %(levelname)s: %(message)s",
+        datefmt="%b/%d %H:%M:%S",
+        level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description="Export the recipe history to columnar files.")
+    parser.add_argument("--out", default="./exports")
+    parser.add_argument("--format", choices=["parquet", "arrow", "csv"], default="parquet")
+    parser.add_argument("--tables", nargs="+", choices=sorted(TABLES), default=None)
+    parser.add_argument("--full", action="store_true", help="export everything, not only the new records")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    counts = export_history(read_configs(), args.out, args.format, args.tables, not args.full, args.batch_size)
+    print(json.dumps(counts))
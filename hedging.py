@@ -0,0 +1,222 @@
+import asyncio
+import atexit
+import threading
+from collections import deque
+
+import aiohttp
+import numpy as np
+import openai
+
+
+def init_hedging(self) -> None:
+    """
+    Reset the latency windows, the hedge budget and the hedge counters.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        None
+    """
+    self.hedge_latencies = {}
+    self.hedge_budget = float(self.hedging_configs["budget_burst"])
+    self.hedge_stats = {"requests": 0, "hedges": 0, "hedge_wins": 0, "denied": 0, "deadline_exceeded": 0}
+    self.hedge_lock = threading.Lock()
+    # the event loop and HTTP session shared by all the calls, started on first use
+    self.hedge_loop = None
+    self.hedge_session = None
+
+
+def hedge_delay(self, model: str) -> float:
+    """
+    Get how long to wait for a model before sending a hedge: the configured percentile
+    of its recent latencies, or initial_delay_s until enough latencies are known.
+
+    Args:
+        self (object): The object.
+        model (str): The model.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    configs = self.hedging_configs
+    with self.hedge_lock:
+        latencies = list(self.hedge_latencies.get(model, ()))
+    if len(latencies) < configs["min_samples"]:
+        return configs["initial_delay_s"]
+    delay = float(np.percentile(latencies, configs["percentile"]))
+    return min(max(delay, configs["min_delay_s"]), configs["max_delay_s"])
+
+
+def take_hedge_token(self) -> bool:
+    """
+    Spend one hedge from the budget. The budget grows by budget_ratio per request, up to budget_burst.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        bool: True if the hedge can be sent.
+    """
+    with self.hedge_lock:
+        if self.hedge_budget >= 1:
+            self.hedge_budget -= 1
+            self.hedge_stats["hedges"] += 1
+            return True
+        self.hedge_stats["denied"] += 1
+        return False
+
+
+def record_latency(self, model: str, latency_s: float) -> None:
+    """
+    Add a latency to the recent latencies of a model.
+
+    Args:
+        self (object): The object.
+        model (str): The model.
+        latency_s (float): The latency in seconds.
+
+    Returns:
+        None
+    """
+    with self.hedge_lock:
+        self.hedge_latencies.setdefault(model, deque(maxlen=self.hedging_configs["window"])).append(latency_s)
+
+
+async def hedged_chat_completion(self, model: str, messages: list, timeout_s: float) -> dict:
+    """
+    Send a chat completion, cancelled after timeout_s.
+
+    When hedging is enabled and the answer takes longer than hedge_delay, a duplicate
+    request is sent, the first answer wins and the other request is cancelled.
+
+    Args:
+        self (object): The object.
+        model (str): The model.
+        messages (list): The chat messages.
+        timeout_s (float): The time left before the deadline of the request.
+
+    Raises:
+        asyncio.TimeoutError: If no answer arrived before the deadline.
+        Exception: The error of the last failed attempt.
+
+    Returns:
+        dict: The response.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_s
+    started = {}
+
+    def attempt() -> asyncio.Task:
+        task = asyncio.ensure_future(openai.ChatCompletion.acreate(
+            model=model,
+            messages=messages,
+            temperature=self.chat_completion_temperature,
+            max_tokens=self.chat_completion_max_completion_length,
+            top_p=self.chat_completion_top_p,
+        ))
+        started[task] = loop.time()
+        return task
+
+    with self.hedge_lock:
+        self.hedge_stats["requests"] += 1
+        self.hedge_budget = min(self.hedge_budget + self.hedging_configs["budget_ratio"],
+                                self.hedging_configs["budget_burst"])
+
+    primary = attempt()
+    pending = {primary}
+    # without hedging there is nothing to wait for but the deadline
+    hedge_at = loop.time() + hedge_delay(self, model) if self.hedging_enabled else None
+    error = None
+    try:
+        while pending:
+            now = loop.time()
+            if now >= deadline:
+                with self.hedge_lock:
+                    self.hedge_stats["deadline_exceeded"] += 1
+                raise asyncio.TimeoutError(f"No answer from {model} after {timeout_s:.1f}s")
+            wait = deadline - now if hedge_at is None else min(deadline, hedge_at) - now
+            done, pending = await asyncio.wait(pending, timeout=max(wait, 0), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    record_latency(self, model, loop.time() - started[task])
+                    if task is not primary:
+                        with self.hedge_lock:
+                            self.hedge_stats["hedge_wins"] += 1
+                    return task.result()
+                error = task.exception()
+            if hedge_at is not None and loop.time() >= hedge_at:
+                hedge_at = None
+                if take_hedge_token(self):
+                    self.logger.info("Hedging the request to %s.", model)
+                    pending.add(attempt())
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def start_hedging_loop(self) -> asyncio.AbstractEventLoop:
+    """
+    Get the event loop running the chat completions, started on a background thread on first use.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        asyncio.AbstractEventLoop: The event loop.
+    """
+    with self.hedge_lock:
+        if self.hedge_loop is None:
+            self.hedge_loop = asyncio.new_event_loop()
+            threading.Thread(target=self.hedge_loop.run_forever, name="chat-completion-loop", daemon=True).start()
+            atexit.register(stop_hedging_loop, self)
+        return self.hedge_loop
+
+
+def stop_hedging_loop(self) -> None:
+    """
+    Close the HTTP session and stop the event loop of the chat completions.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        None
+    """
+    with self.hedge_lock:
+        loop, self.hedge_loop = self.hedge_loop, None
+    if loop is None:
+        return
+    if self.hedge_session is not None:
+        asyncio.run_coroutine_threadsafe(self.hedge_session.close(), loop).result(timeout=5)
+        self.hedge_session = None
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def call_chat_completion(self, model: str, messages: list, timeout_s: float) -> dict:
+    """
+    Send a chat completion with a deadline and optional hedging, see hedged_chat_completion.
+
+    The calls run on one long-lived event loop and share one HTTP session, so the
+    connections to the API are kept alive and reused.
+
+    Args:
+        self (object): The object.
+        model (str): The model.
+        messages (list): The chat messages.
+        timeout_s (float): The time left before the deadline of the request.
+
+    Returns:
+        dict: The response.
+    """
+    async def run():
+        # the loop thread runs one coroutine step at a time, so the session is only created once
+        if self.hedge_session is None or self.hedge_session.closed:
+            self.hedge_session = aiohttp.ClientSession()
+        openai.aiosession.set(self.hedge_session)
+        return await hedged_chat_completion(self, model, messages, timeout_s)
+
+    return asyncio.run_coroutine_threadsafe(run(), start_hedging_loop(self)).result()
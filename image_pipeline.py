@@ -0,0 +1,315 @@
+import argparse
+import atexit
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+PIL_FORMATS = {"webp": "WEBP", "jpeg": "JPEG", "jpg": "JPEG", "png": "PNG"}
+
+logger = logging.getLogger(__name__)
+
+
+def read_configs(path: str = 'configs.json') -> dict:
+    # Load the image processing section of the configs.json file
+    with open(path, 'r') as f:
+        configs = json.load(f)
+    return configs['configs']['recipe_manager_ai']['image_processing']
+
+
+def content_hash(path: str) -> str:
+    """
+    Compute the sha256 of a file.
+
+    Args:
+        path (str): The file.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def perceptual_hash(image: Image.Image) -> str:
+    """
+    Compute the 64 bits difference hash of an image. Near-identical images have hashes
+    with a small Hamming distance.
+
+    Args:
+        image (Image.Image): The image.
+
+    Returns:
+        str: The hash, as 16 hex digits.
+    """
+    pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+def hamming_distance(hash_a: str, hash_b: str) -> int:
+    """
+    Count the bits that differ between two perceptual hashes.
+
+    Args:
+        hash_a (str): The first hash.
+        hash_b (str): The second hash.
+
+    Returns:
+        int: The Hamming distance, from 0 to 64.
+    """
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+
+def save_rendition(image: Image.Image, path: Path, format: str, quality: int) -> None:
+    """
+    Save a rendition. No exif, icc_profile or pnginfo is passed, so it carries no metadata.
+
+    Args:
+        image (Image.Image): The image.
+        path (Path): The rendition file.
+        format (str): "webp", "jpeg" or "png".
+        quality (int): The quality of the lossy formats.
+
+    Returns:
+        None
+    """
+    if PIL_FORMATS[format] == "JPEG":
+        image.save(path, "JPEG", quality=quality, optimize=True, progressive=True)
+    elif PIL_FORMATS[format] == "WEBP":
+        image.save(path, "WEBP", quality=quality, method=4)
+    else:
+        image.save(path, "PNG", optimize=True)
+
+
+def process_image(path: str, digest: str, configs: dict) -> dict:
+    """
+    Make the renditions and the thumbnail of an image and compute its perceptual hash.
+    Runs in the worker processes of the pool.
+
+    Args:
+        path (str): The image.
+        digest (str): The content hash of the image.
+        configs (dict): The image processing configs.
+
+    Returns:
+        dict: The manifest record of the image.
+    """
+    out_path = Path(configs["output_path"])
+    out_path.mkdir(parents=True, exist_ok=True)
+    stem = Path(path).stem
+    renditions = []
+    with Image.open(path) as source:
+        # drop the metadata by keeping only the pixels
+        image = ImageOps.exif_transpose(source).convert("RGB")
+    for size in configs["sizes"]:
+        resized = image.copy()
+        # thumbnail() keeps the aspect ratio and never enlarges the image
+        resized.thumbnail((size, size), Image.LANCZOS)
+        for format in configs["formats"]:
+            target = out_path / f"{stem}_{size}.{format}"
+            save_rendition(resized, target, format, configs["quality"])
+            renditions.append({"path": str(target), "format": format, "width": resized.width, "height": resized.height})
+    thumbnail_size = configs["thumbnail_size"]
+    thumbnail = ImageOps.fit(image, (thumbnail_size, thumbnail_size), Image.LANCZOS)
+    thumbnail_paths = []
+    for format in configs["formats"]:
+        target = out_path / f"{stem}_thumb.{format}"
+        save_rendition(thumbnail, target, format, configs["quality"])
+        thumbnail_paths.append(str(target))
+    return {
+        "content_hash": digest,
+        "source": str(path),
+        "phash": perceptual_hash(image),
+        "width": image.width,
+        "height": image.height,
+        "renditions": renditions,
+        "thumbnails": thumbnail_paths,
+        "processed_at": time.time(),
+    }
+
+
+def iter_manifest(path: str):
+    """
+    Stream the records of the image manifest.
+
+    Args:
+        path (str): The manifest file.
+
+    Yields:
+        dict: The manifest records.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def find_similar_images(manifest_path: str, max_distance: int) -> list:
+    """
+    Find the pairs of processed images whose perceptual hashes are close.
+
+    Args:
+        manifest_path (str): The manifest file.
+        max_distance (int): The largest Hamming distance between two similar images, out of 64 bits.
+
+    Returns:
+        list: (source a, source b, distance) tuples, closest first.
+    """
+    # the aliases are copies of the images they point to
+    records = [(r["source"], r["phash"]) for r in iter_manifest(manifest_path) if not r.get("alias_of")]
+    pairs = []
+    for i, (source_a, hash_a) in enumerate(records):
+        for source_b, hash_b in records[i + 1:]:
+            distance = hamming_distance(hash_a, hash_b)
+            if distance <= max_distance:
+                pairs.append((source_a, source_b, distance))
+    return sorted(pairs, key=lambda pair: pair[2])
+
+
+class image_pipeline:
+    """
+    This class runs the post-processing of the generated images in a process pool.
+    """
+
+    def __init__(self, configs: dict):
+        self.configs = configs
+        self.lock = threading.Lock()
+        self.pool = None
+        # manifest records of the images already processed, by content hash
+        self.records = {}
+        # the sources already in the manifest, processed or aliased
+        self.sources = set()
+        for record in iter_manifest(configs["manifest_path"]):
+            self.sources.add(record["source"])
+            if not record.get("alias_of"):
+                self.records.setdefault(record["content_hash"], record)
+        # futures of the images being processed, by content hash
+        self.pending = {}
+
+    def submit(self, path: str) -> Optional[Future]:
+        """
+        Queue an image for post-processing. An image identical to an already processed one
+        is not processed again, an alias record pointing to its renditions is added instead.
+
+        Args:
+            path (str): The image.
+
+        Returns:
+            Future: The future of the manifest record, or None if the image is an alias.
+        """
+        digest = content_hash(path)
+        with self.lock:
+            processing = self.pending.get(digest)
+            if processing is None and digest in self.records:
+                if str(path) in self.sources:
+                    logger.info("Image %s already processed, skipped.", path)
+                    return None
+                logger.info("Image %s already processed, aliased.", path)
+                self.write_record(self.alias_record(self.records[digest], path))
+                return None
+            if processing is None:
+                if self.pool is None:
+                    # spawn, since forking the threads of the application is unsafe
+                    self.pool = ProcessPoolExecutor(max_workers=self.configs["workers"],
+                                                    mp_context=multiprocessing.get_context("spawn"))
+                    atexit.register(self.shutdown)
+                future = self.pool.submit(process_image, str(path), digest, self.configs)
+                self.pending[digest] = future
+        # the callbacks are added without the lock: a finished future runs them right away, in this thread
+        if processing is not None:
+            logger.info("Image %s already being processed, aliased.", path)
+            processing.add_done_callback(lambda f: self.record_alias(digest, path))
+            return None
+        future.add_done_callback(lambda f: self.record(f, digest, path))
+        return future
+
+    def record(self, future: Future, digest: str, path: str) -> None:
+        """
+        Append the record of a processed image to the manifest, or allow a retry when the processing failed.
+        """
+        try:
+            record = future.result()
+        except Exception as e:
+            logger.info("Error processing image %s: %s", path, e)
+            with self.lock:
+                self.pending.pop(digest, None)
+            return
+        with self.lock:
+            self.records[digest] = record
+            self.pending.pop(digest, None)
+            self.write_record(record)
+
+    def record_alias(self, digest: str, path: str) -> None:
+        """
+        Append the alias record of an image identical to an image that was being processed.
+        """
+        with self.lock:
+            if digest in self.records:
+                self.write_record(self.alias_record(self.records[digest], path))
+            else:
+                logger.info("Image %s not aliased, the processing of its identical image failed.", path)
+
+    @staticmethod
+    def alias_record(record: dict, path: str) -> dict:
+        # same renditions, thumbnails and hashes, under the new source
+        return dict(record, source=str(path), alias_of=record["source"], processed_at=time.time())
+
+    def write_record(self, record: dict) -> None:
+        # called with the lock held
+        self.sources.add(record["source"])
+        with open(self.configs["manifest_path"], "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def shutdown(self) -> None:
+        """
+        Wait for the queued images and stop the worker processes.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s | %(levelname)s: %(message)s",
+        datefmt="%b/%d %H:%M:%S",
+        level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description="Post-process the generated recipe images.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    process_parser = subparsers.add_parser("process", help="process images or directories of images")
+    process_parser.add_argument("paths", nargs="+")
+    similar_parser = subparsers.add_parser("similar", help="list the near-identical processed images")
+    similar_parser.add_argument("--distance", type=int, default=6)
+    args = parser.parse_args()
+
+    configs = read_configs()
+    if args.command == "process":
+        pipeline = image_pipeline(configs)
+        for path in args.paths:
+            files = sorted(Path(path).glob("*.png")) if os.path.isdir(path) else [Path(path)]
+            for file in files:
+                pipeline.submit(str(file))
+        pipeline.shutdown()
+    else:
+        for source_a, source_b, distance in find_similar_images(configs["manifest_path"], args.distance):
+            print(f"{distance:2d} {source_a} {source_b}")
@@ -0,0 +1,441 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+from typing import Optional
+
+PENDING, IN_FLIGHT, DONE, FAILED = "pending", "in_flight", "done", "failed"
+
+logger = logging.getLogger(__name__)
+
+
+class permanent_job_error(Exception):
+    """
+    Raised when a job can never succeed, it is failed without retry.
+    """
+
+
+def read_configs(path: str = 'configs.json') -> dict:
+    # Load the job queue section of the configs.json file
+    with open(path, 'r') as f:
+        configs = json.load(f)
+    return configs['configs']['recipe_manager_ai']['job_queue']
+
+
+def open_job_queue(path: str) -> sqlite3.Connection:
+    """
+    Open the job queue, creating it if needed.
+
+    The queue is a SQLite database in WAL mode, so several worker processes can drain it.
+
+    Args:
+        path (str): The database file.
+
+    Returns:
+        sqlite3.Connection: The connection, in autocommit mode.
+    """
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_until REAL,
+            available_at REAL NOT NULL DEFAULT 0,
+            checkpoint TEXT,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, available_at)")
+    return conn
+
+
+def job_key(job: dict) -> str:
+    """
+    Compute the idempotency key of a job.
+
+    Args:
+        job (dict): The job, with its ingredients, instructions and is_strict_ingredients.
+                    An explicit "key" is used as is.
+
+    Returns:
+        str: The idempotency key.
+    """
+    if job.get("key"):
+        return str(job["key"])
+    canonical = json.dumps({
+        "ingredients": [i.strip().lower() for i in job.get("ingredients", [])],
+        "instructions": job.get("instructions", "").strip(),
+        "is_strict_ingredients": job.get("is_strict_ingredients", "no"),
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def enqueue_jobs(conn: sqlite3.Connection, jobs: list) -> tuple:
+    """
+    Add jobs to the queue. Jobs whose idempotency key is already queued are skipped.
+
+    Args:
+        conn (sqlite3.Connection): The job queue.
+        jobs (list): The jobs.
+
+    Returns:
+        tuple: (number of added jobs, number of skipped jobs)
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO jobs (key, payload, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            [(job_key(job), json.dumps(job), now, now) for job in jobs])
+        added = conn.total_changes - before
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return added, len(jobs) - added
+
+
+def claim_job(conn: sqlite3.Connection, worker: str, lease_s: float, max_attempts: int) -> Optional[dict]:
+    """
+    Take the next available job and lease it to a worker.
+
+    Jobs whose lease expired, because their worker crashed, are available again, unless
+    they already used max_attempts attempts: those are failed, so a job that crashes its
+    workers is not retried forever.
+
+    Args:
+        conn (sqlite3.Connection): The job queue.
+        worker (str): The id of the worker.
+        lease_s (float): How long the job stays leased to the worker.
+        max_attempts (int): The job is failed after this many attempts.
+
+    Returns:
+        dict: The job row, or None if no job is available.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "UPDATE jobs SET state = ?, error = ?, lease_until = NULL, updated_at = ? "
+            "WHERE state = ? AND lease_until < ? AND attempts >= ?",
+            (FAILED, f"Lease expired on each of the {max_attempts} attempts", now, IN_FLIGHT, now, max_attempts))
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE (state = ? AND available_at <= ?) OR (state = ? AND lease_until < ?) "
+            "ORDER BY id LIMIT 1", (PENDING, now, IN_FLIGHT, now)).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            (IN_FLIGHT, worker, now + lease_s, now, row["id"]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    job = dict(row)
+    job["attempts"] += 1
+    job["worker"] = worker
+    return job
+
+
+def checkpoint_job(conn: sqlite3.Connection, job_id: int, worker: str, checkpoint: dict) -> bool:
+    """
+    Save the progress of a leased job, so a retry does not redo the finished steps.
+
+    Args:
+        conn (sqlite3.Connection): The job queue.
+        job_id (int): The job.
+        worker (str): The worker holding the lease.
+        checkpoint (dict): The progress of the job.
+
+    Returns:
+        bool: False if the worker lost its lease.
+    """
+    cursor = conn.execute(
+        "UPDATE jobs SET checkpoint = ?, updated_at = ? WHERE id = ? AND worker = ? AND state = ?",
+        (json.dumps(checkpoint), time.time(), job_id, worker, IN_FLIGHT))
+    return cursor.rowcount == 1
+
+
+def complete_job(conn: sqlite3.Connection, job_id: int, worker: str, result: dict) -> bool:
+    """
+    Mark a leased job as done.
+
+    Args:
+        conn (sqlite3.Connection): The job queue.
+        job_id (int): The job.
+        worker (str): The worker holding the lease.
+        result (dict): The result of the job.
+
+    Returns:
+        bool: False if the worker lost its lease.
+    """
+    cursor = conn.execute(
+        "UPDATE jobs SET state = ?, result = ?, error = NULL, lease_until = NULL, updated_at = ? "
+        "WHERE id = ? AND worker = ? AND state = ?",
+        (DONE, json.dumps(result), time.time(), job_id, worker, IN_FLIGHT))
+    return cursor.rowcount == 1
+
+
+def fail_job(conn: sqlite3.Connection, job: dict, error: str, max_attempts: int, backoff_s: float, permanent: bool = False) -> bool:
+    """
+    Release a leased job after an error, to be retried with an exponential backoff.
+
+    Args:
+        conn (sqlite3.Connection): The job queue.
+        job (dict): The job row returned by claim_job.
+        error (str): The error.
+        max_attempts (int): The job is failed after this many attempts.
+        backoff_s (float): The delay before the first retry, doubled on each attempt.
+        permanent (bool): Fail the job without retry.
+
+    Returns:
+        bool: False if the worker lost its lease.
+    """
+    now = time.time()
+    if permanent or job["attempts"] >= max_attempts:
+        state, available_at = FAILED, now
+    else:
+        state, available_at = PENDING, now + backoff_s * 2 ** (job["attempts"] - 1)
+    cursor = conn.execute(
+        "UPDATE jobs SET state = ?, error = ?, available_at = ?, lease_until = NULL, updated_at = ? "
+        "WHERE id = ? AND worker = ? AND state = ?",
+        (state, error, available_at, now, job["id"], job["worker"], IN_FLIGHT))
+    return cursor.rowcount == 1
+
+
+def retry_failed_jobs(conn: sqlite3.Connection) -> int:
+    """
+    Put the failed jobs back in the queue.
+
+    Args:
+        conn (sqlite3.Connection): The job queue.
+
+    Returns:
+        int: The number of jobs put back.
+    """
+    cursor = conn.execute(
+        "UPDATE jobs SET state = ?, attempts = 0, available_at = 0, updated_at = ? WHERE state = ?",
+        (PENDING, time.time(), FAILED))
+    return cursor.rowcount
+
+
+def queue_stats(conn: sqlite3.Connection) -> dict:
+    """
+    Count the jobs per state.
+
+    Args:
+        conn (sqlite3.Connection): The job queue.
+
+    Returns:
+        dict: The number of jobs per state.
+    """
+    stats = {PENDING: 0, IN_FLIGHT: 0, DONE: 0, FAILED: 0}
+    for row in conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state"):
+        stats[row["state"]] = row["n"]
+    return stats
+
+
+def next_job_at(conn: sqlite3.Connection) -> Optional[float]:
+    """
+    Find when the next pending or in flight job can be claimed: the end of its backoff or of its lease.
+
+    Args:
+        conn (sqlite3.Connection): The job queue.
+
+    Returns:
+        float: The earliest time, or None if no job is pending or in flight.
+    """
+    row = conn.execute(
+        "SELECT MIN(CASE WHEN state = ? THEN available_at ELSE lease_until END) AS at FROM jobs WHERE state IN (?, ?)",
+        (PENDING, PENDING, IN_FLIGHT)).fetchone()
+    return row["at"]
+
+
+def run_job(self, conn: sqlite3.Connection, job: dict) -> dict:
+    """
+    Generate the recipe of a job, checkpointing the saved request, the response and each saved choice,
+    so a retry neither calls the API nor saves the request, the response or the images again.
+
+    Args:
+        self (object): The object.
+        conn (sqlite3.Connection): The job queue.
+        job (dict): The job row returned by claim_job.
+
+    Raises:
+        permanent_job_error: If the job is invalid.
+        Exception: If the generation failed and may succeed on retry.
+
+    Returns:
+        dict: The result of the job.
+    """
+    from recipe_manager_ai import (verify_format, create_ingredient_json, create_recipe_prompt,
+                                   save_request_to_db, create_recipe_from_ai, save_recipe_response)
+    from write_behind import flush_write_behind
+
+    payload = json.loads(job["payload"])
+    checkpoint = json.loads(job["checkpoint"]) if job["checkpoint"] else {}
+
+    if "response" not in checkpoint:
+        ingredient_list = []
+        for item in payload.get("ingredients", []):
+            if not verify_format(self, item):
+                raise permanent_job_error(f"Invalid item format: {item}")
+            ingredient_list.append(create_ingredient_json(self, item))
+        messages = create_recipe_prompt(self, ingredient_list, payload.get("instructions", ""),
+                                        payload.get("is_strict_ingredients", "no"))
+        if not messages:
+            raise permanent_job_error("Invalid recipe prompt")
+
+        if not checkpoint.get("request_saved"):
+            # a retry must not count the request twice in requests.json,
+            # and the request is only checkpointed once it is on disk
+            if not save_request_to_db(self, messages) or not flush_write_behind(self):
+                raise Exception("Error saving the request")
+            checkpoint["request_saved"] = True
+            if not checkpoint_job(conn, job["id"], job["worker"], checkpoint):
+                raise Exception("Lease lost")
+        response = create_recipe_from_ai(self, messages)
+        if response is None:
+            raise Exception("Error generating recipe")
+        checkpoint["response"] = json.loads(json.dumps(response))
+        if not checkpoint_job(conn, job["id"], job["worker"], checkpoint):
+            raise Exception("Lease lost")
+    else:
+        self.logger.info("Resuming job %d from its checkpoint.", job["id"])
+
+    def checkpoint_outputs(outputs: list) -> None:
+        # a choice is only checkpointed once its files are on disk, a retry skips it
+        if not flush_write_behind(self):
+            raise Exception("Error saving the outputs")
+        checkpoint["outputs"] = outputs
+        if not checkpoint_job(conn, job["id"], job["worker"], checkpoint):
+            raise Exception("Lease lost")
+
+    _, _, outputs = save_recipe_response(self, checkpoint["response"], checkpoint.get("outputs"), checkpoint_outputs)
+    return {"response_id": checkpoint["response"].get("id"), "usage": checkpoint["response"].get("usage"), "outputs": outputs}
+
+
+def work(configs: dict, worker: str, max_jobs: int = 0) -> int:
+    """
+    Drain the job queue until no job is pending or in flight. The worker waits for the jobs
+    in backoff and for the leases of the other workers, which may expire.
+
+    Args:
+        configs (dict): The job queue configs.
+        worker (str): The id of the worker.
+        max_jobs (int): Stop after this many jobs, 0 for no limit.
+
+    Returns:
+        int: The number of jobs done.
+    """
+    from recipe_manager_ai import recipe_manager_ai
+    from write_behind import stop_write_behind
+
+    app = recipe_manager_ai()
+    conn = open_job_queue(configs["path"])
+    done = 0
+    try:
+        while not max_jobs or done < max_jobs:
+            job = claim_job(conn, worker, configs["lease_s"], configs["max_attempts"])
+            if job is None:
+                at = next_job_at(conn)
+                if at is None:
+                    break
+                # woken up at least every backoff_s, to pick up newly enqueued jobs
+                time.sleep(min(max(at - time.time(), 0.1), configs["backoff_s"]))
+                continue
+            app.logger.info("Worker %s running job %d, attempt %d.", worker, job["id"], job["attempts"])
+            try:
+                result = run_job(app, conn, job)
+            except permanent_job_error as e:
+                fail_job(conn, job, str(e), configs["max_attempts"], configs["backoff_s"], permanent=True)
+                continue
+            except Exception as e:
+                fail_job(conn, job, str(e), configs["max_attempts"], configs["backoff_s"])
+                continue
+            if complete_job(conn, job["id"], worker, result):
+                done += 1
+    finally:
+        # flush the results before the process exits
+        stop_write_behind(app)
+        conn.close()
+    return done
+
+
+def read_jobs(path: str) -> list:
+    """
+    Read a job file, one JSON job per line.
+
+    Args:
+        path (str): The job file.
+
+    Returns:
+        list: The jobs.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s | %(levelname)s: %(message)s",
+        datefmt="%b/%d %H:%M:%S",
+        level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description="Durable job queue for batch recipe generation.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    enqueue_parser = subparsers.add_parser("enqueue", help="add the jobs of a JSON lines file")
+    enqueue_parser.add_argument("path")
+    enqueue_parser.add_argument("--preflight", action="store_true", help="validate the jobs first and skip the invalid ones")
+    work_parser = subparsers.add_parser("work", help="drain the queue")
+    work_parser.add_argument("--processes", type=int, default=1)
+    work_parser.add_argument("--max-jobs", type=int, default=0, help="per process, 0 for no limit")
+    subparsers.add_parser("status", help="count the jobs per state")
+    subparsers.add_parser("retry-failed", help="put the failed jobs back in the queue")
+    args = parser.parse_args()
+
+    configs = read_configs()
+    conn = open_job_queue(configs["path"])
+    if args.command == "enqueue":
+        jobs = read_jobs(args.path)
+        if args.preflight:
+            from recipe_manager_ai import recipe_manager_ai
+            from preflight import preflight_jobs
+            results, report = preflight_jobs(recipe_manager_ai(), jobs)
+            logger.info("Preflight: %s", json.dumps(report))
+            for result in results:
+                if result["errors"]:
+                    logger.info("Rejected job %d: %s", result["index"], "; ".join(result["errors"]))
+            jobs = [result["job"] for result in results if not result["errors"]]
+        added, skipped = enqueue_jobs(conn, jobs)
+        logger.info("Added %d jobs, skipped %d already queued.", added, skipped)
+    elif args.command == "retry-failed":
+        logger.info("Put %d failed jobs back in the queue.", retry_failed_jobs(conn))
+    elif args.command == "work":
+        prefix = f"{socket.gethostname()}-{os.getpid()}"
+        if args.processes == 1:
+            work(configs, prefix, args.max_jobs)
+        else:
+            processes = [multiprocessing.Process(target=work, args=(configs, f"{prefix}-{i}", args.max_jobs))
+                         for i in range(args.processes)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+    print(json.dumps(queue_stats(conn)))
@@ -0,0 +1,143 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from recipe_manager_ai import (recipe_manager_ai, create_recipe_from_ai, create_image_prompt,
+                               create_recipe_image_from_ai)
+from output_store import new_result_id
+
+
+def load_recorded_prompts(self) -> list:
+    """
+    Load the chat messages of the past requests to replay them as load.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        list: The list of chat messages.
+    """
+    prompts = []
+    with open(self.db_path + "/requests.json", "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                recipe_prompt = json.loads(line)["recipe_prompt"]
+            except (ValueError, KeyError):
+                continue
+            if isinstance(recipe_prompt, list) and recipe_prompt:
+                prompts.append(recipe_prompt)
+            elif isinstance(recipe_prompt, str) and recipe_prompt:
+                prompts.append([{"role": "user", "content": recipe_prompt}])
+    return prompts
+
+
+def run_one(self, messages: list, with_image: bool) -> bool:
+    """
+    Drive one recipe generation through the application.
+
+    Args:
+        self (object): The object.
+        messages (list): The chat messages of the request.
+        with_image (bool): Also generate and download the recipe image.
+
+    Returns:
+        bool: True if the request succeeded, False otherwise.
+    """
+    response = create_recipe_from_ai(self, messages)
+    if response is None:
+        return False
+    if with_image:
+        try:
+            json_data = json.loads(response["choices"][0]["message"]["content"])
+        except (ValueError, KeyError, IndexError, TypeError):
+            return False
+        filename, _, _ = create_recipe_image_from_ai(self, create_image_prompt(self, json_data), new_result_id(self))
+        return bool(filename)
+    return True
+
+
+def generate_load(self, prompts: list, qps: float, duration_s: float, concurrency: int, with_image: bool) -> dict:
+    """
+    Send requests at a fixed rate and collect their latencies.
+
+    The arrival schedule is open-loop: a slow response does not delay the next
+    request, and each latency is measured from the scheduled start so queueing
+    in the client is counted.
+
+    Args:
+        self (object): The object.
+        prompts (list): The chat messages to cycle through.
+        qps (float): The target number of requests per second.
+        duration_s (float): How long to generate load.
+        concurrency (int): The maximum number of requests in flight.
+        with_image (bool): Also generate and download the recipe images.
+
+    Returns:
+        dict: The load test report.
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def task(messages, scheduled):
+        ok = run_one(self, messages, with_image)
+        elapsed_ms = (time.perf_counter() - scheduled) * 1000
+        with lock:
+            (latencies if ok else errors).append(elapsed_ms)
+
+    total = int(qps * duration_s)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(total):
+            scheduled = start + i / qps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(task, prompts[i % len(prompts)], scheduled)
+    wall_s = time.perf_counter() - start
+
+    report = {
+        "target_qps": qps,
+        "sent": total,
+        "succeeded": len(latencies),
+        "failed": len(errors),
+        "wall_s": round(wall_s, 3),
+        "throughput_qps": round(len(latencies) / wall_s, 3) if wall_s else 0.0,
+    }
+    report["models"] = self.model_stats
+    report["hedging"] = self.hedge_stats
+    if latencies:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        report.update({"p50_ms": round(p50, 1), "p95_ms": round(p95, 1), "p99_ms": round(p99, 1),
+                       "max_ms": round(max(latencies), 1)})
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive the recipe manager AI at a target QPS.")
+    parser.add_argument("--qps", type=float, default=1.0)
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--image", action="store_true", help="also generate the recipe images")
+    parser.add_argument("--api-base", default="", help="e.g. http://127.0.0.1:8765/v1 for the replay server")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    app = recipe_manager_ai()
+    if args.api_base:
+        import openai
+        openai.api_base = args.api_base
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    prompts = load_recorded_prompts(app)
+    if not prompts:
+        raise SystemExit("No recorded requests found in " + app.db_path + "/requests.json")
+
+    report = generate_load(app, prompts, args.qps, args.duration, args.concurrency, args.image)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,153 @@
+import json
+import re
+import threading
+import time
+
+# the ingredients_prompt inserted by create_recipe_prompt into the query
+_INGREDIENTS_PROMPT_PATTERN = re.compile(r'\{"instruction":.*?"ingredients":\[.*?\]\}')
+
+
+def init_router(self) -> None:
+    """
+    Load the routed models and reset their observed latency and error rate.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        None
+    """
+    self.router_models = {}
+    for model in self.router_configs["models"]:
+        self.router_models[model["name"]] = model
+    if self.chat_completion_model not in self.router_models:
+        # the configured model can always be routed to, with unknown prices
+        self.router_models[self.chat_completion_model] = {
+            "name": self.chat_completion_model, "tier": "fast", "context_window": self.chat_completion_max_token_length,
+            "prompt_cost_per_1k": 0.0, "completion_cost_per_1k": 0.0,
+        }
+    self.model_stats = {name: {"calls": 0, "errors": 0, "latency_s": None, "error_rate": 0.0, "updated_at": 0.0}
+                        for name in self.router_models}
+    self.model_stats_lock = threading.Lock()
+
+
+def estimate_prompt_tokens(self, messages: list) -> int:
+    """
+    Estimate the number of prompt tokens of chat messages.
+
+    Args:
+        self (object): The object.
+        messages (list): The chat messages.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    # each message costs about 4 tokens of formatting on top of its content
+    return sum(len(self.enc.encode(m.get("content", ""))) + 4 for m in messages) + 3
+
+
+def request_complexity(self, messages: list) -> str:
+    """
+    Classify a recipe request as "simple" or "complex" from its ingredients and instructions.
+
+    Args:
+        self (object): The object.
+        messages (list): The chat messages built by create_recipe_prompt.
+
+    Returns:
+        str: "simple" or "complex".
+    """
+    content = " ".join(m.get("content", "") for m in messages if m.get("role") == "user")
+    try:
+        ingredients_prompt = json.loads(_INGREDIENTS_PROMPT_PATTERN.findall(content)[-1])
+    except (IndexError, ValueError):
+        return "complex"
+    ingredient_count = len(ingredients_prompt["ingredients"])
+    # each separated instruction is one more constraint for the model
+    constraint_count = len([c for c in re.split(r"[,.;]", ingredients_prompt["instruction"]) if c.strip()])
+    if (ingredient_count <= self.router_configs["simple_max_ingredients"]
+            and constraint_count <= self.router_configs["simple_max_constraints"]):
+        return "simple"
+    return "complex"
+
+
+def decayed_error_rate(self, stats: dict, now: float) -> float:
+    """
+    Get the error rate of a model, halved every error_half_life_s without calls, so a model
+    that is no longer tried after an outage becomes healthy again and gets probed.
+
+    Args:
+        self (object): The object.
+        stats (dict): The stats of the model.
+        now (float): The current time.
+
+    Returns:
+        float: The error rate.
+    """
+    idle_s = max(now - stats["updated_at"], 0.0)
+    return stats["error_rate"] * 0.5 ** (idle_s / self.router_configs["error_half_life_s"])
+
+
+def route_models(self, messages: list) -> list:
+    """
+    Order the models to try for a request, the first one is used and the next ones are failovers.
+
+    Models whose context window cannot hold the prompt and the completion are skipped.
+    Healthy models come first, then the models of the tier matching the complexity of
+    the request, then the lowest expected cost, where the observed latency is priced by
+    latency_cost_per_s.
+
+    Args:
+        self (object): The object.
+        messages (list): The chat messages.
+
+    Returns:
+        list: The model names, in the order to try them.
+    """
+    prompt_tokens = estimate_prompt_tokens(self, messages)
+    completion_tokens = self.chat_completion_max_completion_length
+    tier = "fast" if request_complexity(self, messages) == "simple" else "strong"
+
+    candidates = []
+    now = time.time()
+    with self.model_stats_lock:
+        for name, model in self.router_models.items():
+            if prompt_tokens + completion_tokens > model["context_window"]:
+                continue
+            stats = self.model_stats[name]
+            cost = (prompt_tokens * model["prompt_cost_per_1k"] + completion_tokens * model["completion_cost_per_1k"]) / 1000
+            if stats["latency_s"] is not None:
+                cost += stats["latency_s"] * self.router_configs["latency_cost_per_s"]
+            healthy = decayed_error_rate(self, stats, now) <= self.router_configs["max_error_rate"]
+            candidates.append(((not healthy, model["tier"] != tier, cost), name))
+    models = [name for _, name in sorted(candidates)]
+    self.logger.info("Routing %s request of %d prompt tokens to %s.", tier, prompt_tokens, models)
+    return models
+
+
+def record_model_result(self, model: str, latency_s: float, ok: bool) -> None:
+    """
+    Update the moving averages of the latency and error rate of a model.
+
+    Args:
+        self (object): The object.
+        model (str): The model.
+        latency_s (float): The duration of the call in seconds.
+        ok (bool): The call succeeded.
+
+    Returns:
+        None
+    """
+    alpha = self.router_configs["ewma_alpha"]
+    with self.model_stats_lock:
+        stats = self.model_stats.setdefault(model, {"calls": 0, "errors": 0, "latency_s": None, "error_rate": 0.0, "updated_at": 0.0})
+        stats["calls"] += 1
+        now = time.time()
+        error_rate = decayed_error_rate(self, stats, now)
+        stats["error_rate"] = (1 - alpha) * error_rate + alpha * (0.0 if ok else 1.0)
+        stats["updated_at"] = now
+        if ok:
+            stats["latency_s"] = latency_s if stats["latency_s"] is None else (1 - alpha) * stats["latency_s"] + alpha * latency_s
+        else:
+            stats["errors"] += 1
+
@@ -0,0 +1,197 @@
+import json
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, Optional
+
+from write_behind import enqueue_write
+
+# the bundle index entries already read, by index file: (offset read up to, {(id, suffix): entry})
+_index_cache = {}
+_index_lock = threading.Lock()
+
+# the first bytes of every bundle index entry, see commit_writes
+INDEX_ENTRY_START = b'{"id": '
+
+
+def new_result_id(self) -> str:
+    """
+    Create a collision-free result id: the timestamp followed by 64 random bits.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        str: The result id. format: YYYY-MM-DD_HHMMSS_<16 hex digits>
+    """
+    return f"{datetime.now().strftime('%Y-%m-%d_%H%M%S')}_{uuid.uuid4().hex[:16]}"
+
+
+def result_shard(result_id: str) -> Path:
+    """
+    Get the shard of a result: its date, then the first two hex digits of its random part.
+
+    Args:
+        result_id (str): The result id.
+
+    Returns:
+        Path: The shard, relative to the output path, e.g. 2023/05/12/3f
+    """
+    year, month, day = result_id.partition("_")[0].split("-")
+    return Path(year) / month / day / result_id.rsplit("_", 1)[-1][:2]
+
+
+def result_extension(self) -> str:
+    """
+    Get the extension of the result files.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        str: ".md" if markdown is configured, ".txt" otherwise.
+    """
+    return ".md" if self.markdown else ".txt"
+
+
+def bundle_paths(self, result_id: str) -> tuple:
+    """
+    Get the bundle of this process for the day of a result, and the index of the result.
+
+    Each process appends to its own bundle, so a bundle has a single writer. The results of
+    all the bundles of a day are indexed by the first two hex digits of their random part,
+    so a lookup only reads one of 256 index files.
+
+    Args:
+        self (object): The object.
+        result_id (str): The result id.
+
+    Returns:
+        tuple: (bundle path, index path)
+    """
+    directory = Path(self.chat_completion_output_path) / "bundles" / result_id.partition("_")[0]
+    name = f"bundle_{socket.gethostname()}_{os.getpid()}"
+    return directory / (name + ".dat"), directory / f"index_{result_id.rsplit('_', 1)[-1][:2]}.idx"
+
+
+def store_result(self, content: str, result_id: str, suffix: str = "") -> Path:
+    """
+    Queue a result for writing, as a sharded file or appended to a bundle.
+
+    Args:
+        self (object): The object.
+        content (str): The result.
+        result_id (str): The result id.
+        suffix (str): The kind of result, "" for the raw response and "_JSON_" for the recipe.
+
+    Returns:
+        Path: The result file or the bundle.
+    """
+    if self.output_store_layout == "flat":
+        path = Path(self.chat_completion_output_path) / f"result_{suffix}{result_id}{result_extension(self)}"
+    elif self.output_store_bundle:
+        path, index_path = bundle_paths(self, result_id)
+        enqueue_write(self, path, {"index": str(index_path), "id": result_id, "suffix": suffix, "content": content}, "bundle")
+        return path
+    else:
+        path = Path(self.chat_completion_output_path) / result_shard(result_id) / f"result_{suffix}{result_id}{result_extension(self)}"
+    enqueue_write(self, path, content, "replace")
+    return path
+
+
+def iter_bundle_index(index_path: str, offset: int = 0) -> Iterator[tuple]:
+    """
+    Stream the complete entries of a bundle index from a byte offset.
+
+    A process that crashed while appending leaves a partial entry, which the next append
+    is glued to, so the entries are resynchronized on the start of the last entry of a line.
+
+    Args:
+        index_path (str): The index file.
+        offset (int): The byte offset to start from.
+
+    Yields:
+        tuple: (offset after the entry, entry)
+    """
+    with open(index_path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                return
+            offset += len(line)
+            try:
+                yield offset, json.loads(line)
+            except ValueError:
+                start = line.rfind(INDEX_ENTRY_START)
+                if start <= 0:
+                    continue
+                try:
+                    yield offset, json.loads(line[start:])
+                except ValueError:
+                    continue
+
+
+def read_bundle_entry(bundle_path: str, entry: dict) -> str:
+    """
+    Read a result from a bundle.
+
+    Args:
+        bundle_path (str): The bundle file.
+        entry (dict): The index entry of the result.
+
+    Returns:
+        str: The result.
+    """
+    with open(bundle_path, "rb") as f:
+        f.seek(entry["offset"])
+        return f.read(entry["length"]).decode("utf-8")
+
+
+def find_bundle_entry(index_path: str, result_id: str, suffix: str) -> Optional[dict]:
+    """
+    Find a result in a bundle index. The entries are cached, and only the entries added
+    since the last lookup are read.
+
+    Args:
+        index_path (str): The index file.
+        result_id (str): The result id.
+        suffix (str): The kind of result.
+
+    Returns:
+        dict: The index entry, or None if it is not found.
+    """
+    with _index_lock:
+        offset, entries = _index_cache.get(index_path, (0, {}))
+        if os.path.exists(index_path) and os.path.getsize(index_path) > offset:
+            for offset, entry in iter_bundle_index(index_path, offset):
+                entries[(entry["id"], entry["suffix"])] = entry
+            _index_cache[index_path] = (offset, entries)
+        return entries.get((result_id, suffix))
+
+
+def load_result(self, result_id: str, suffix: str = "") -> Optional[str]:
+    """
+    Load a stored result, whatever the layout it was written with.
+
+    Args:
+        self (object): The object.
+        result_id (str): The result id.
+        suffix (str): The kind of result, "" for the raw response and "_JSON_" for the recipe.
+
+    Returns:
+        str: The result, or None if it is not found.
+    """
+    out_path = Path(self.chat_completion_output_path)
+    name = f"result_{suffix}{result_id}"
+    for extension in (".txt", ".md"):
+        for path in (out_path / result_shard(result_id) / (name + extension), out_path / (name + extension)):
+            if path.exists():
+                return path.read_text(encoding="utf-8")
+    _, index_path = bundle_paths(self, result_id)
+    entry = find_bundle_entry(str(index_path), result_id, suffix)
+    if entry is not None:
+        return read_bundle_entry(str(index_path.parent / entry["bundle"]), entry)
+    return None
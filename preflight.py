@@ -0,0 +1,232 @@
+import argparse
+import json
+import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator
+
+from recipe_manager_ai import (verify_format, create_ingredient_json, create_ingredients_prompt,
+                               is_json_valid, prompt_loading)
+
+# the placeholder replaced by the ingredients prompt in create_recipe_prompt
+INGREDIENTS_PLACEHOLDER = "[ingredients_prompt]"
+
+
+def iter_job_file(path: str) -> Iterator:
+    """
+    Stream the jobs of a job file. A line that is not valid JSON is yielded as is, to be rejected.
+
+    Args:
+        path (str): The job file, one JSON job per line.
+
+    Yields:
+        dict: The jobs.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield line.strip()
+
+
+def preflight_job(self, job) -> tuple:
+    """
+    Validate a job with the checks of the recipe generation, without the token count.
+
+    Args:
+        self (object): The object.
+        job (dict): The job, with its ingredients, instructions and is_strict_ingredients.
+
+    Returns:
+        tuple: (list of errors, ingredients prompt or None if the job is invalid)
+    """
+    if not isinstance(job, dict):
+        return ["Invalid job: not a JSON object"], None
+    ingredients = job.get("ingredients", [])
+    instructions = job.get("instructions", "")
+    is_strict_ingredients = job.get("is_strict_ingredients", "no")
+    if not isinstance(ingredients, list):
+        return ["Invalid ingredients: not a list"], None
+    errors = []
+    ingredient_list = []
+    for item in ingredients:
+        if isinstance(item, str) and verify_format(self, item):
+            ingredient_list.append(create_ingredient_json(self, item))
+        else:
+            errors.append(f"Invalid item format: {item}")
+    if not isinstance(instructions, str):
+        errors.append("Invalid instructions: not a string")
+    if is_strict_ingredients not in ("yes", "no"):
+        errors.append(f"Invalid is_strict_ingredients: {is_strict_ingredients}")
+    if errors:
+        return errors, None
+    ingredients_prompt = create_ingredients_prompt(self, ingredient_list, instructions, is_strict_ingredients)
+    if not is_json_valid(self, ingredients_prompt):
+        return ["Invalid JSON: the ingredients prompt is malformed"], None
+    return [], ingredients_prompt
+
+
+def count_tokens(self, texts: list, threads: int) -> list:
+    """
+    Count the tokens of texts with the batch encoding of tiktoken, across threads.
+
+    Args:
+        self (object): The object.
+        texts (list): The texts.
+        threads (int): The number of encoding threads.
+
+    Returns:
+        list: The number of tokens of each text.
+    """
+    # the special tokens are rejected by preflight_jobs, so the check per text is skipped,
+    # and only the counts are kept: the token lists of a chunk are dropped right away
+    return [len(tokens) for tokens in self.enc.encode_batch(texts, num_threads=threads, disallowed_special=())]
+
+
+def projected_cost(self, prompt_tokens: int, completion_tokens: int) -> dict:
+    """
+    Price a number of tokens with each configured model.
+
+    Args:
+        self (object): The object.
+        prompt_tokens (int): The prompt tokens.
+        completion_tokens (int): The completion tokens.
+
+    Returns:
+        dict: The cost in dollars per model.
+    """
+    return {
+        name: round(prompt_tokens / 1000 * model["prompt_cost_per_1k"]
+                    + completion_tokens / 1000 * model["completion_cost_per_1k"], 4)
+        for name, model in self.router_models.items()
+    }
+
+
+def preflight_jobs(self, jobs: Iterable, threads: int = 0, chunk_size: int = 10000, margin: int = 32) -> tuple:
+    """
+    Validate and token-count a batch of jobs before any API call.
+
+    The prompt files are loaded and encoded once. Only the ingredients prompt of each job is
+    encoded, by chunks of unique prompts, and the next chunk is validated while the previous
+    one is encoded. Added to the tokens of the prompt files, this count can be off by a few
+    tokens where the two texts meet, so the full prompt of the jobs within margin tokens of
+    the limit is encoded again, and the limit is checked exactly like check_if_prompt_is_too_long.
+
+    Args:
+        self (object): The object.
+        jobs (Iterable): The jobs.
+        threads (int): The number of encoding threads, the number of CPUs by default.
+        chunk_size (int): The number of jobs validated and encoded together.
+        margin (int): The jobs whose approximate count is within margin tokens of the limit are counted exactly.
+
+    Raises:
+        ValueError: If the prompt files cannot be loaded.
+
+    Returns:
+        tuple: (results, report). results holds one dict per job, in order, with the job, its
+               errors and its prompt tokens. report sums up the batch and its projected cost.
+    """
+    started = time.perf_counter()
+    threads = threads or os.cpu_count() or 1
+    prompt = prompt_loading(self)
+    if INGREDIENTS_PLACEHOLDER not in prompt:
+        raise ValueError(f"No {INGREDIENTS_PLACEHOLDER} in the prompt files of {self.chat_completion_prompt_path}")
+    template_tokens = len(self.enc.encode(prompt.replace(INGREDIENTS_PLACEHOLDER, "[]")))
+    # the limit of check_if_prompt_is_too_long
+    limit = self.chat_completion_max_token_length - self.chat_completion_max_completion_length
+    special_tokens = self.enc.special_tokens_set
+
+    results = []
+    chunks = []
+    near_limit = []
+    level = self.logger.level
+    # the validation functions log every item, which would dominate the run time
+    self.logger.setLevel(logging.WARNING)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as encoder:
+            jobs = iter(jobs)
+            while True:
+                chunk = list(islice(jobs, chunk_size))
+                if not chunk:
+                    break
+                texts = {}
+                first = len(results)
+                for job in chunk:
+                    errors, ingredients_prompt = preflight_job(self, job)
+                    if ingredients_prompt is not None and any(token in ingredients_prompt for token in special_tokens):
+                        # create_recipe_prompt fails on them when encoding the prompt
+                        errors, ingredients_prompt = ["Invalid prompt: contains a special token"], None
+                    if ingredients_prompt is not None:
+                        texts.setdefault(ingredients_prompt, len(texts))
+                    results.append({"index": len(results) + 1, "job": job, "errors": errors,
+                                    "prompt_tokens": 0, "ingredients_prompt": ingredients_prompt})
+                # tiktoken releases the GIL while encoding
+                chunks.append((first, texts, encoder.submit(count_tokens, self, list(texts), threads)))
+            for first, texts, future in chunks:
+                counts = future.result()
+                for result in results[first:first + chunk_size]:
+                    ingredients_prompt = result.pop("ingredients_prompt")
+                    if ingredients_prompt is None:
+                        continue
+                    result["prompt_tokens"] = template_tokens + counts[texts[ingredients_prompt]]
+                    if abs(result["prompt_tokens"] - limit) <= margin:
+                        near_limit.append((result, ingredients_prompt))
+            if near_limit:
+                full_prompts = [prompt.replace(INGREDIENTS_PLACEHOLDER, f"[{ingredients_prompt}]")
+                                for _, ingredients_prompt in near_limit]
+                for (result, _), count in zip(near_limit, count_tokens(self, full_prompts, threads)):
+                    result["prompt_tokens"] = count
+        for result in results:
+            if result["prompt_tokens"] > limit:
+                result["errors"].append(f"Prompt too long: {result['prompt_tokens']} tokens, limit {limit}")
+    finally:
+        self.logger.setLevel(level)
+
+    accepted = [result for result in results if not result["errors"]]
+    prompt_tokens = sum(result["prompt_tokens"] for result in accepted)
+    completion_tokens = len(accepted) * self.chat_completion_max_completion_length
+    report = {
+        "jobs": len(results),
+        "accepted": len(accepted),
+        "rejected": len(results) - len(accepted),
+        "errors": dict(Counter(error.split(":")[0] for result in results for error in result["errors"])),
+        "prompt_tokens": prompt_tokens,
+        # an upper bound, each completion can use max_completion_length tokens
+        "completion_tokens": completion_tokens,
+        "projected_cost": projected_cost(self, prompt_tokens, completion_tokens),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    return results, report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s | %(levelname)s: %(message)s",
+        datefmt="%b/%d %H:%M:%S",
+        level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description="Validate and token-count a job file before any API call.")
+    parser.add_argument("path")
+    parser.add_argument("--accepted", default="", help="write the valid jobs to this JSON lines file")
+    parser.add_argument("--rejected", default="", help="write the rejected jobs and their errors to this JSON lines file")
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    from recipe_manager_ai import recipe_manager_ai
+
+    results, report = preflight_jobs(recipe_manager_ai(), iter_job_file(args.path), args.threads, args.chunk_size)
+    if args.accepted:
+        with open(args.accepted, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(result["job"]) + "\n" for result in results if not result["errors"])
+    if args.rejected:
+        with open(args.rejected, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps({"index": result["index"], "job": result["job"], "errors": result["errors"]}) + "\n"
+                         for result in results if result["errors"])
+    print(json.dumps(report))
@@ -0,0 +1,333 @@
+import argparse
+import ast
+import json
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Optional, Sequence, Union
+
+import numpy as np
+
+# Dimensions of the units, quantities are converted through the base unit of their dimension
+MASS, VOLUME, COUNT, UNKNOWN = 0, 1, 2, 3
+
+# unit name -> (dimension, size in grams or millilitres, canonical name)
+UNITS = {}
+for names, dimension, size, canonical in [
+    (["mg", "milligram", "milligramme"], MASS, 0.001, "mg"),
+    (["g", "gr", "gram", "gramme"], MASS, 1.0, "g"),
+    (["kg", "kilo", "kilogram", "kilogramme"], MASS, 1000.0, "kg"),
+    (["oz", "ounce", "once"], MASS, 28.3495, "oz"),
+    (["lb", "lbs", "pound", "livre"], MASS, 453.592, "lb"),
+    (["ml", "millilitre", "milliliter"], VOLUME, 1.0, "ml"),
+    (["cl", "centilitre", "centiliter"], VOLUME, 10.0, "cl"),
+    (["dl", "decilitre", "deciliter"], VOLUME, 100.0, "dl"),
+    (["l", "litre", "liter"], VOLUME, 1000.0, "l"),
+    (["tsp", "teaspoon", "cuillere a cafe", "c. a cafe", "c.a.c", "cac"], VOLUME, 5.0, "tsp"),
+    (["tbsp", "tablespoon", "cuillere a soupe", "c. a soupe", "c.a.s", "cas"], VOLUME, 15.0, "tbsp"),
+    (["fl oz", "fluid ounce"], VOLUME, 29.5735, "fl oz"),
+    (["cup"], VOLUME, 236.588, "cup"),
+    (["tasse"], VOLUME, 250.0, "tasse"),
+    (["pint", "pinte"], VOLUME, 473.176, "pint"),
+    (["", "unit", "unite", "piece", "tige", "stalk", "slice", "tranche", "gousse", "clove",
+      "can", "boite", "pincee", "pinch", "feuille", "leaf", "bunch", "botte"], COUNT, 1.0, None),
+]:
+    for name in names:
+        UNITS[name] = (dimension, size, canonical)
+
+# unit_system -> dimension -> [(upper bound in base unit, unit, size)], first matching bound wins
+UNIT_SYSTEMS = {
+    "metric": {
+        MASS: [(1000.0, "g", 1.0), (np.inf, "kg", 1000.0)],
+        VOLUME: [(1000.0, "ml", 1.0), (np.inf, "l", 1000.0)],
+    },
+    "us": {
+        MASS: [(453.592, "oz", 28.3495), (np.inf, "lb", 453.592)],
+        VOLUME: [(15.0, "tsp", 5.0), (59.147, "tbsp", 15.0), (np.inf, "cup", 236.588)],
+    },
+}
+
+_NUMBER = r"\d+(?:[.,]\d+)?(?:\s*/\s*\d+)?"
+_QUANTITY_PATTERN = re.compile(rf"^\s*(\d+\s+\d+\s*/\s*\d+|{_NUMBER})\s*(.*)$")
+_RANGE_PATTERN = re.compile(rf"^\s*({_NUMBER})\s*(?:-|–|to|à)\s*({_NUMBER})\s*(.*)$")
+_STEP_QUANTITY_PATTERN = re.compile(rf"({_NUMBER}(?:\s*(?:-|to|à|x)\s*{_NUMBER})?)[\s-]*([^\W\d_][\w.']*(?:\s+(?:à|a)\s+\w+)?|°)")
+_TIME_WORDS = {"min", "mins", "minute", "minutes", "h", "hr", "hrs", "hour", "hours", "heure", "heures", "sec", "seconds", "secondes"}
+_SIZE_WORDS = {"inch", "inches", "in", "pouce", "pouces", "cm", "mm"}
+
+
+def normalize_unit(unit: Optional[str]) -> str:
+    """
+    Normalize a unit name: lower case, no accents, no plural.
+
+    Args:
+        unit (str): The unit as emitted by the model, e.g. "cuillères à café".
+
+    Returns:
+        str: The normalized unit, e.g. "cuillere a cafe".
+    """
+    if not unit:
+        return ""
+    unit = unicodedata.normalize("NFKD", unit.strip().lower())
+    unit = "".join(c for c in unit if not unicodedata.combining(c))
+    # singularize every word, "cuilleres a cafe" -> "cuillere a cafe"
+    return " ".join(w[:-1] if len(w) > 3 and w.endswith("s") else w for w in unit.split())
+
+
+@lru_cache(maxsize=4096)
+def lookup_unit(unit: Optional[str]) -> tuple:
+    """
+    Find the dimension and size of a unit.
+
+    Args:
+        unit (str): The unit as emitted by the model.
+
+    Returns:
+        tuple: (dimension, size in the base unit, canonical name or None).
+    """
+    return UNITS.get(normalize_unit(unit), (UNKNOWN, np.nan, None))
+
+
+@lru_cache(maxsize=4096)
+def parse_quantity(quantity: Union[str, float, int, None]) -> tuple:
+    """
+    Parse a quantity such as "2.5", "1/2", "1 1/2" or "1 tsp".
+
+    Args:
+        quantity (str): The quantity as emitted by the model.
+
+    Returns:
+        tuple: (value or nan, unit found after the number or "").
+    """
+    if isinstance(quantity, (int, float)):
+        return float(quantity), ""
+    match = _QUANTITY_PATTERN.match(quantity or "")
+    if not match:
+        return np.nan, ""
+    value = 0.0
+    for part in match.group(1).replace(",", ".").split():
+        if "/" in part:
+            numerator, denominator = part.split("/")
+            if float(denominator) == 0:
+                return np.nan, ""
+            value += float(numerator) / float(denominator)
+        else:
+            value += float(part)
+    return value, match.group(2).strip()
+
+
+@lru_cache(maxsize=4096)
+def parse_quantity_range(quantity: Union[str, float, int, None]) -> tuple:
+    """
+    Parse a quantity that can be a range, such as "2-3" or "2 à 3 tbsp", see parse_quantity.
+
+    Args:
+        quantity (str): The quantity as emitted by the model.
+
+    Returns:
+        tuple: (low value or nan, high value or nan if the quantity is not a range, unit found after the numbers or "").
+    """
+    match = _RANGE_PATTERN.match(quantity) if isinstance(quantity, str) else None
+    if match:
+        low, high = parse_quantity(match.group(1))[0], parse_quantity(match.group(2))[0]
+        if np.isfinite(low) and np.isfinite(high):
+            return low, high, match.group(3).strip()
+    value, unit = parse_quantity(quantity)
+    return value, np.nan, unit
+
+
+def format_quantity(value: float) -> str:
+    """
+    Format a quantity without useless decimals.
+
+    Args:
+        value (float): The quantity.
+
+    Returns:
+        str: The formatted quantity.
+    """
+    if value >= 10:
+        return f"{value:.0f}"
+    return f"{value:.2f}".rstrip("0").rstrip(".")
+
+
+def flag_steps(steps: Union[list, str, None], scaled: bool, converted: bool) -> list:
+    """
+    Find the preparation steps with quantities that do not follow the rescaling.
+
+    Amounts written in the steps are flagged whenever the recipe is rescaled or
+    converted, times and pan sizes only when it is rescaled. Temperatures are ignored.
+
+    Args:
+        steps (list or str): The prepSteps of the recipe.
+        scaled (bool): The servings were changed.
+        converted (bool): The units were converted.
+
+    Returns:
+        list: The flagged steps, as dict with the step index, text and reasons.
+    """
+    if isinstance(steps, str):
+        steps = [steps]
+    flags = []
+    for index, step in enumerate(steps or []):
+        if not isinstance(step, str):
+            continue
+        reasons = []
+        for amount, word in _STEP_QUANTITY_PATTERN.findall(step):
+            word = word.lower()
+            if word == "°" or word.startswith("°"):
+                continue
+            if word in _TIME_WORDS:
+                reason = "time" if scaled else None
+            elif word in _SIZE_WORDS:
+                reason = "pan_size" if scaled else None
+            elif lookup_unit(word)[0] in (MASS, VOLUME):
+                reason = "amount" if scaled or converted else None
+            else:
+                continue
+            if reason and f"{reason}: {amount} {word}" not in reasons:
+                reasons.append(f"{reason}: {amount} {word}")
+        if reasons:
+            flags.append({"step": index, "text": step, "reasons": reasons})
+    return flags
+
+
+def scale_recipes(recipes: Sequence[dict], servings: Union[int, float, Sequence], unit_system: Optional[str] = None) -> list:
+    """
+    Rescale the ingredients and servings of a collection of recipes, and optionally convert the units.
+
+    The quantities of the whole collection are processed as numpy arrays, no API call is made.
+    Ingredients whose quantity or unit cannot be read are kept as they are and flagged.
+
+    Args:
+        recipes (list): The recipes, as generated in the "_JSON_" result files.
+        servings (int or list): The target servings, one for all recipes or one per recipe.
+        unit_system (str): None to keep the units, "metric" or "us" to convert them.
+
+    Returns:
+        list: The rescaled recipes, each with a "scaling_flags" entry.
+    """
+    if unit_system is not None and unit_system not in UNIT_SYSTEMS:
+        raise ValueError(f"Invalid unit system '{unit_system}', available systems: {', '.join(UNIT_SYSTEMS)}")
+
+    count = len(recipes)
+    target = np.broadcast_to(np.asarray(servings, dtype=np.float64), (count,))
+    current = np.array([parse_quantity(r.get("servings"))[0] if r.get("servings") is not None else np.nan
+                        for r in recipes], dtype=np.float64)
+    # recipes without a usable serving count are only converted
+    factors = np.where(np.isfinite(current) & (current > 0), target / np.where(current > 0, current, 1), 1.0)
+
+    recipe_index, values, highs, dimensions, sizes, units, leftovers = [], [], [], [], [], [], []
+    for i, recipe in enumerate(recipes):
+        for ingredient in recipe.get("ingredients") or []:
+            value, high, embedded_unit = parse_quantity_range(ingredient.get("quantity"))
+            unit = ingredient.get("unit_of_measure") or embedded_unit
+            dimension, size, _ = lookup_unit(unit)
+            # text after the number that is neither the unit of measure nor empty is not rescaled
+            leftovers.append(bool(embedded_unit) and normalize_unit(embedded_unit) != normalize_unit(unit)
+                             and (lookup_unit(embedded_unit) != lookup_unit(unit) or lookup_unit(embedded_unit)[0] == UNKNOWN))
+            recipe_index.append(i)
+            values.append(value)
+            highs.append(high)
+            dimensions.append(dimension)
+            sizes.append(size)
+            units.append(unit)
+
+    recipe_index = np.array(recipe_index, dtype=np.intp)
+    scaled = np.array(values, dtype=np.float64) * factors[recipe_index]
+    scaled_highs = np.array(highs, dtype=np.float64) * factors[recipe_index]
+    dimensions = np.array(dimensions, dtype=np.int8)
+    out_values = scaled.copy()
+    out_highs = scaled_highs.copy()
+    out_units = np.array(units, dtype=object)
+
+    if unit_system is not None:
+        base = scaled * np.array(sizes, dtype=np.float64)
+        base_highs = scaled_highs * np.array(sizes, dtype=np.float64)
+        for dimension, bounds in UNIT_SYSTEMS[unit_system].items():
+            in_dimension = (dimensions == dimension) & np.isfinite(base)
+            for upper, unit, size in reversed(bounds):
+                # both ends of a range take the unit of its low end
+                selected = in_dimension & (base < upper)
+                out_values[selected] = base[selected] / size
+                out_highs[selected] = base_highs[selected] / size
+                out_units[selected] = unit
+
+    results = []
+    position = 0
+    for i, recipe in enumerate(recipes):
+        scaled_recipe = dict(recipe)
+        ingredients = []
+        flags = []
+        for ingredient in recipe.get("ingredients") or []:
+            value = out_values[position]
+            scaled_ingredient = dict(ingredient)
+            if np.isfinite(value):
+                scaled_ingredient["quantity"] = format_quantity(value)
+                if np.isfinite(out_highs[position]):
+                    scaled_ingredient["quantity"] += "-" + format_quantity(out_highs[position])
+                if out_units[position] != ingredient.get("unit_of_measure"):
+                    scaled_ingredient["unit_of_measure"] = out_units[position]
+            if not np.isfinite(value) or leftovers[position]:
+                flags.append({"ingredient": ingredient.get("name"), "reasons": [f"unreadable quantity: {ingredient.get('quantity')}"]})
+            if unit_system is not None and dimensions[position] == UNKNOWN and np.isfinite(value):
+                flags.append({"ingredient": ingredient.get("name"), "reasons": [f"unknown unit: {units[position]}"]})
+            ingredients.append(scaled_ingredient)
+            position += 1
+
+        is_scaled = bool(factors[i] != 1.0)
+        if not (np.isfinite(current[i]) and current[i] > 0):
+            flags.append({"servings": recipe.get("servings"),
+                          "reasons": [f"unreadable servings: {recipe.get('servings')}, quantities not rescaled"]})
+        if recipe.get("ingredients") is not None:
+            scaled_recipe["ingredients"] = ingredients
+        if is_scaled:
+            scaled_recipe["servings"] = int(target[i]) if float(target[i]).is_integer() else float(target[i])
+        flags.extend(flag_steps(recipe.get("prepSteps"), is_scaled, unit_system is not None))
+        scaled_recipe["scaling_flags"] = flags
+        results.append(scaled_recipe)
+    return results
+
+
+def scale_recipe(recipe: dict, servings: Union[int, float], unit_system: Optional[str] = None) -> dict:
+    """
+    Rescale one recipe, see scale_recipes.
+
+    Args:
+        recipe (dict): The recipe.
+        servings (int): The target servings.
+        unit_system (str): None to keep the units, "metric" or "us" to convert them.
+
+    Returns:
+        dict: The rescaled recipe.
+    """
+    return scale_recipes([recipe], servings, unit_system)[0]
+
+
+def load_recipe(path: str) -> dict:
+    """
+    Load a recipe from a "_JSON_" result file.
+
+    Args:
+        path (str): The result file.
+
+    Returns:
+        dict: The recipe.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    try:
+        return json.loads(content)
+    except ValueError:
+        # the result files hold the repr of the recipe dict
+        return ast.literal_eval(content)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rescale stored recipes without calling the API.")
+    parser.add_argument("paths", nargs="+", help="_JSON_ result files")
+    parser.add_argument("--servings", type=float, required=True)
+    parser.add_argument("--units", choices=sorted(UNIT_SYSTEMS), default=None)
+    args = parser.parse_args()
+
+    for recipe in scale_recipes([load_recipe(p) for p in args.paths], args.servings, args.units):
+        print(json.dumps(recipe, indent=2, ensure_ascii=False))
@@ -0,0 +1,318 @@
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+_record_lock = threading.Lock()
+
+
+def read_configs(path: str = 'configs.json') -> dict:
+    # Load the replay section of the configs.json file
+    with open(path, 'r') as f:
+        configs = json.load(f)
+    return configs['configs']['recipe_manager_ai']['replay']
+
+
+def exchange_key(kind: str, request: Any) -> str:
+    """
+    Compute the key used to match a request against the recordings.
+
+    Args:
+        kind (str): The kind of exchange, "chat" or "image".
+        request (Any): The messages of a chat request or the prompt of an image request.
+
+    Returns:
+        str: The sha256 hex digest of the canonical request.
+    """
+    canonical = json.dumps([kind, request], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def record_exchange(self, kind: str, request: Any, response: Any, latency_ms: float, image_path: str = "") -> bool:
+    """
+    Append a real API exchange to the recordings file.
+
+    Args:
+        self (object): The object.
+        kind (str): The kind of exchange, "chat" or "image".
+        request (Any): The messages of a chat request or the prompt of an image request.
+        response (Any): The response returned by the API.
+        latency_ms (float): The observed latency of the call in milliseconds.
+        image_path (str): The downloaded image, stored inline since the API URLs expire.
+
+    Returns:
+        bool: True if the exchange was recorded, False otherwise.
+    """
+    if not self.replay_record:
+        return False
+    try:
+        record = {
+            "kind": kind,
+            "key": exchange_key(kind, request),
+            "request": request,
+            "response": json.loads(json.dumps(response)),
+            "latency_ms": round(latency_ms, 3),
+            "recorded_at": time.time(),
+        }
+        if image_path:
+            with open(image_path, "rb") as f:
+                record["image_b64"] = base64.b64encode(f.read()).decode("ascii")
+        with _record_lock:
+            with open(self.replay_recordings_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        return True
+    except Exception as e:
+        self.logger.info("Error recording exchange: %s", e)
+        return False
+
+
+def placeholder_png(width: int = 64, height: int = 64) -> bytes:
+    """
+    Build a plain PNG used when no image was recorded.
+
+    Args:
+        width (int): The width of the image.
+        height (int): The height of the image.
+
+    Returns:
+        bytes: The PNG file content.
+    """
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    row = b"\x00" + b"\xd9\x8c\x4a" * width
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(row * height)) + chunk(b"IEND", b""))
+
+
+class replay_store:
+    """
+    This class holds the recorded exchanges served by the replay server.
+    """
+
+    def __init__(self, recordings_path: str, seed_responses_path: str = ""):
+        self.chat = {}
+        self.chat_pool = []
+        self.images = {}
+        self.image_pool = []
+        self.placeholder = placeholder_png()
+
+        if seed_responses_path and Path(seed_responses_path).exists():
+            # responses.json already holds real chat completions, use them as a fallback pool
+            with open(seed_responses_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        response = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(response, dict) and "choices" in response:
+                        self.chat_pool.append({"response": response, "latency_ms": None})
+
+        if Path(recordings_path).exists():
+            with open(recordings_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a partially written last line is skipped
+                        continue
+                    if record["kind"] == "chat":
+                        self.chat.setdefault(record["key"], []).append(record)
+                        self.chat_pool.append(record)
+                    elif record["kind"] == "image":
+                        self.images.setdefault(record["key"], []).append(record)
+                        self.image_pool.append(record)
+
+        logger.info("Loaded %d chat and %d image recordings.", len(self.chat_pool), len(self.image_pool))
+
+    def find(self, kind: str, request: Any) -> Optional[dict]:
+        # exact match first, then any recording of the same kind
+        by_key, pool = (self.chat, self.chat_pool) if kind == "chat" else (self.images, self.image_pool)
+        matches = by_key.get(exchange_key(kind, request))
+        if matches:
+            return random.choice(matches)
+        if pool:
+            return random.choice(pool)
+        return None
+
+
+def sample_latency_ms(latency_configs: dict, recorded_ms: Optional[float]) -> float:
+    """
+    Draw a simulated latency from the configured distribution.
+
+    Args:
+        latency_configs (dict): The latency section of the replay configs.
+        recorded_ms (float): The latency observed when the exchange was recorded, if any.
+
+    Returns:
+        float: The latency in milliseconds.
+    """
+    distribution = latency_configs["distribution"]
+    if distribution == "recorded" and recorded_ms is not None:
+        return recorded_ms
+    if distribution == "fixed":
+        return latency_configs["median_ms"]
+    if distribution == "uniform":
+        return random.uniform(latency_configs["min_ms"], latency_configs["max_ms"])
+    # lognormal, also used for "recorded" when nothing was recorded, clamped to [min_ms, max_ms]
+    latency_ms = random.lognormvariate(0, latency_configs["sigma"]) * latency_configs["median_ms"]
+    return min(max(latency_ms, latency_configs["min_ms"]), latency_configs["max_ms"])
+
+
+class replay_request_handler(BaseHTTPRequestHandler):
+    """
+    This class answers OpenAI API calls from the recordings.
+    """
+
+    store: replay_store = None
+    configs: dict = {}
+    # keep the connections alive, like the API does
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send_json(self, status: int, body: dict, headers: Optional[dict] = None):
+        payload = json.dumps(body).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client cancelled the request, e.g. the loser of a hedged request
+            self.close_connection = True
+
+    def inject_fault(self) -> bool:
+        """
+        Simulate a rate limit, a server error or a timeout according to the configs.
+
+        Returns:
+            bool: True if a fault was sent instead of a response.
+        """
+        errors = self.configs["errors"]
+        draw = random.random()
+        if draw < errors["rate_limit_rate"]:
+            self.send_json(429, {"error": {"message": "Rate limit reached (replay).", "type": "requests", "code": "rate_limit_exceeded"}},
+                           {"Retry-After": str(errors["retry_after_s"])})
+            return True
+        draw -= errors["rate_limit_rate"]
+        if draw < errors["server_error_rate"]:
+            self.send_json(500, {"error": {"message": "The server had an error (replay).", "type": "server_error"}})
+            return True
+        draw -= errors["server_error_rate"]
+        if draw < errors["timeout_rate"]:
+            # hold the connection past the client timeout, then drop it without answering
+            time.sleep(errors["timeout_s"])
+            self.close_connection = True
+            return True
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": {"message": "Invalid JSON body.", "type": "invalid_request_error"}})
+            return
+
+        if self.path.endswith("/chat/completions"):
+            kind, request = "chat", body.get("messages")
+        elif self.path.endswith("/images/generations"):
+            kind, request = "image", body.get("prompt")
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown endpoint {self.path}", "type": "invalid_request_error"}})
+            return
+
+        record = self.store.find(kind, request)
+        time.sleep(sample_latency_ms(self.configs["latency"][kind], record and record.get("latency_ms")) / 1000)
+        if self.inject_fault():
+            return
+
+        if kind == "chat":
+            if record is None:
+                self.send_json(503, {"error": {"message": "No chat recording available.", "type": "server_error"}})
+                return
+            response = dict(record["response"])
+            response["created"] = int(time.time())
+            if body.get("model"):
+                response["model"] = body["model"]
+            self.send_json(200, response)
+        else:
+            image_id = record["key"] if record else "placeholder"
+            host, port = self.server.server_address[:2]
+            url = f"http://{host}:{port}/v1/replay/images/{image_id}.png"
+            self.send_json(200, {"created": int(time.time()), "data": [{"url": url}] * int(body.get("n", 1))})
+
+    def do_GET(self):
+        if not self.path.startswith("/v1/replay/images/"):
+            self.send_json(404, {"error": {"message": f"Unknown endpoint {self.path}", "type": "invalid_request_error"}})
+            return
+        image_id = self.path.rsplit("/", 1)[-1].split(".")[0]
+        records = self.store.images.get(image_id)
+        if records and records[0].get("image_b64"):
+            payload = base64.b64decode(records[0]["image_b64"])
+        else:
+            payload = self.store.placeholder
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def serve(configs: dict, host: str = "", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Create the replay server. Point the "api_base" general config at it to use it.
+
+    Args:
+        configs (dict): The replay configs.
+        host (str): Overrides the configured host.
+        port (int): Overrides the configured port.
+
+    Returns:
+        ThreadingHTTPServer: The server, call serve_forever() to run it.
+    """
+    handler = type("configured_replay_request_handler", (replay_request_handler,), {
+        "store": replay_store(configs["recordings_path"], configs["seed_responses_path"]),
+        "configs": configs,
+    })
+    server = ThreadingHTTPServer((host or configs["host"], port or configs["port"]), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s | %(levelname)s: %(message)s",
+        datefmt="%b/%d %H:%M:%S",
+        level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description="Serve recorded OpenAI exchanges locally.")
+    parser.add_argument("--host", default="")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--configs", default="configs.json")
+    args = parser.parse_args()
+
+    server = serve(read_configs(args.configs), args.host, args.port)
+    host, port = server.server_address[:2]
+    logger.info("Replay server listening, set api_base to http://%s:%d/v1", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
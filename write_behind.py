@@ -0,0 +1,328 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on Windows, where the recovery assumes a single process
+    fcntl = None
+
+_STOP = object()
+
+_bundle_lock = threading.Lock()
+
+# the paths of the failed writes, by the thread that queued them, until its next flush
+_failures_lock = threading.Lock()
+
+
+def recover_append_only_file(self, path: str) -> bool:
+    """
+    Truncate a partially written last line left by a crash in an append-only file.
+
+    The appends hold a shared lock on the file while writing, and the recovery an exclusive
+    one, so the record another process is appending is never mistaken for a partial one.
+
+    Args:
+        self (object): The object.
+        path (str): The file to recover.
+
+    Returns:
+        bool: True if the file was truncated, False otherwise.
+    """
+    try:
+        with open(path, "rb+") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return False
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return False
+            # walk back to the end of the last complete line
+            position = size
+            while position > 0:
+                step = min(4096, position)
+                f.seek(position - step)
+                block = f.read(step)
+                newline = block.rfind(b"\n")
+                if newline != -1:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            f.truncate(position)
+            if self.write_behind_fsync != "never":
+                os.fsync(f.fileno())
+        self.logger.info("Recovered %s, dropped %d bytes of a partial record.", path, size - position)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def start_write_behind(self) -> None:
+    """
+    Recover the append-only files and start the background writer.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        None
+    """
+    for name in ("requests.json", "responses.json"):
+        recover_append_only_file(self, self.db_path + "/" + name)
+
+    self.write_queue = queue.Queue(maxsize=self.write_behind_max_queue)
+    self.write_thread = threading.Thread(target=write_behind_loop, args=(self,), name="write-behind", daemon=True)
+    self.write_thread.start()
+    atexit.register(stop_write_behind, self)
+
+
+def stop_write_behind(self) -> None:
+    """
+    Flush the pending writes and stop the background writer.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        None
+    """
+    write_thread = getattr(self, "write_thread", None)
+    if write_thread is None or not write_thread.is_alive():
+        return
+    self.write_queue.put(_STOP)
+    write_thread.join()
+    self.write_thread = None
+
+
+def flush_write_behind(self) -> bool:
+    """
+    Wait until the writes queued so far are committed, and check those of the current thread.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        bool: True if every write queued by the current thread since its last flush was committed,
+              False otherwise.
+    """
+    write_thread = getattr(self, "write_thread", None)
+    if write_thread is not None and write_thread.is_alive():
+        self.write_queue.join()
+    with _failures_lock:
+        failed = getattr(self, "write_behind_failures", {}).pop(threading.get_ident(), None)
+    if failed:
+        self.logger.error("%d writes failed since the last flush: %s", len(failed), ", ".join(sorted(set(failed))))
+        return False
+    return True
+
+
+def record_failures(self, writes: list) -> None:
+    """
+    Keep the paths of failed writes for the flush of the threads that queued them.
+
+    Args:
+        self (object): The object.
+        writes (list): The failed (path, content, mode, thread) writes.
+
+    Returns:
+        None
+    """
+    with _failures_lock:
+        if not hasattr(self, "write_behind_failures"):
+            self.write_behind_failures = {}
+        for path, _, _, thread in writes:
+            self.write_behind_failures.setdefault(thread, []).append(path)
+
+
+def enqueue_write(self, path: str, content, mode: str = "append") -> bool:
+    """
+    Queue a write for the background writer, or write it now when the writer is not running.
+
+    Args:
+        self (object): The object.
+        path (str): The file to write.
+        content (str or dict): The text to write, or the record to serialize for "append_json".
+        mode (str): "append" adds the text at the end of the file, "append_json" adds the
+                    record as one JSON line, "replace" atomically replaces the file and
+                    "bundle" appends the record content to a bundle, then its offset to
+                    the index of the record.
+
+    Returns:
+        bool: True if the write was queued or done, False otherwise. A queued write can still
+              fail, which the next flush_write_behind of the thread reports.
+    """
+    write = (str(path), content, mode, threading.get_ident())
+    write_thread = getattr(self, "write_thread", None)
+    if write_thread is not None and write_thread.is_alive():
+        self.write_queue.put(write)
+        return True
+    if commit_writes(self, [write]):
+        record_failures(self, [write])
+        return False
+    return True
+
+
+def write_behind_loop(self) -> None:
+    """
+    Drain the write queue, committing the writes in groups.
+
+    A group is closed when it holds write_behind_batch_size writes or when
+    write_behind_max_delay_ms has passed since its first write.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        None
+    """
+    stopping = False
+    while not stopping:
+        batch = [self.write_queue.get()]
+        if batch[0] is _STOP:
+            self.write_queue.task_done()
+            break
+        deadline = time.monotonic() + self.write_behind_max_delay_ms / 1000
+        while len(batch) < self.write_behind_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self.write_queue.get(timeout=timeout) if timeout > 0 else self.write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self.write_queue.task_done()
+                stopping = True
+                break
+            batch.append(item)
+        try:
+            failed = commit_writes(self, batch)
+        except Exception as e:
+            self.logger.error("Error committing %d queued writes: %s", len(batch), e)
+            failed = range(len(batch))
+        if failed:
+            record_failures(self, [batch[position] for position in failed])
+        for _ in batch:
+            self.write_queue.task_done()
+
+
+def commit_writes(self, batch: list) -> list:
+    """
+    Write a group of queued writes, opening each file once. A file that cannot be written
+    does not stop the writes of the other files.
+
+    Args:
+        self (object): The object.
+        batch (list): The (path, content, mode, thread) writes in queue order.
+
+    Returns:
+        list: The positions in batch of the writes that failed.
+    """
+    failed = set()
+    # the texts of each file with the positions of their writes
+    appends = {}
+    replaces = {}
+    bundles = {}
+    for position, (path, content, mode, _) in enumerate(batch):
+        if mode == "append_json":
+            try:
+                appends.setdefault(path, []).append((position, json.dumps(content) + "\n"))
+            except (TypeError, ValueError) as e:
+                self.logger.error("Error serializing a record for %s: %s", path, e)
+                failed.add(position)
+        elif mode == "append":
+            appends.setdefault(path, []).append((position, content))
+        elif mode == "bundle":
+            bundles.setdefault(path, []).append((position, content))
+        else:
+            # only the last version of a replaced file needs to be written
+            replaces.setdefault(path, []).append((position, content))
+
+    fsync = should_fsync(self)
+    for path, records in bundles.items():
+        entries = []
+        try:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            # without the background writer, several threads can append to the bundle of the process
+            with _bundle_lock:
+                with open(path, "ab") as f:
+                    for position, record in records:
+                        data = record["content"].encode("utf-8")
+                        entries.append((record["index"], position, json.dumps({
+                            "id": record["id"], "suffix": record["suffix"], "bundle": Path(path).name,
+                            "offset": f.tell(), "length": len(data)}) + "\n"))
+                        f.write(data)
+                    f.flush()
+                    if fsync:
+                        os.fsync(f.fileno())
+        except OSError as e:
+            self.logger.error("Error writing bundle %s: %s", path, e)
+            failed.update(position for position, _ in records)
+            continue
+        for index_path, position, entry in entries:
+            appends.setdefault(index_path, []).append((position, entry))
+
+    # the index entries are appended after the bundle data, so they never point past its end
+    for path, chunks in appends.items():
+        try:
+            # one O_APPEND write per group so records of several processes never interleave
+            data = "".join(text for _, text in chunks).encode("utf-8")
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                if fcntl is not None:
+                    # released when the file is closed, see recover_append_only_file
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+                written = 0
+                while written < len(data):
+                    written += os.write(fd, data[written:])
+                if fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self.logger.error("Error appending %d records to %s: %s", len(chunks), path, e)
+            failed.update(position for position, _ in chunks)
+
+    for path, versions in replaces.items():
+        target = Path(path)
+        tmp = target.with_name(target.name + ".tmp")
+        try:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(versions[-1][1])
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, target)
+        except OSError as e:
+            self.logger.error("Error replacing %s: %s", path, e)
+            failed.update(position for position, _ in versions)
+    return sorted(failed)
+
+
+def should_fsync(self) -> bool:
+    """
+    Decide whether the current group is fsynced, according to write_behind_fsync.
+
+    "batch" syncs every group, "interval" at most once per write_behind_fsync_interval_ms
+    and "never" leaves it to the operating system.
+
+    Args:
+        self (object): The object.
+
+    Returns:
+        bool: True if the group must be fsynced.
+    """
+    if self.write_behind_fsync == "batch":
+        return True
+    if self.write_behind_fsync == "interval":
+        now = time.monotonic()
+        if now - getattr(self, "write_behind_last_fsync", 0.0) >= self.write_behind_fsync_interval_ms / 1000:
+            self.write_behind_last_fsync = now
+            return True
+    return False